@@ -1,68 +1,199 @@
 import cv2
+import numpy
+from fontTools import ttLib
+from fontTools.pens.basePen import BasePen
 
-class CVFont(object):
-    def __init__(self, charset, fontname, get_cache_fn):
-        self.charset = charset
-        self.fontname = fontname
-        self.chars = {}
-        for c in self.charset:
-            filename = get_cache_fn(fontname, c)
-            self.chars[c] = CVChar(fontname, c, filename)
-
-    def distance_from(self, another_cv_font):
-        dist = 0
-        for c in self.charset:
-            dist = dist + self.chars[c].contour_distance_from(another_cv_font.chars[c])
-        return dist
-
-    def is_null(self):
-        (_, c0) = self.chars.items()[0]
-        for _, c in self.chars.items()[1:]:
-            if 0 < c0.contour_distance_from(c):
-                return False
-        return True
-
-
-
-class CVChar(object):
-    def __init__(self, fontname, charname, filename):
-        self.c = charname
-        self.fontname = fontname
-        self.filename = filename
-
-        self.img = None
-        self.edg = None
-        self.sto = None
-        self.cnt = None
-        self.tre = None
-
-    def contour_distance_from(self, another_cv_char,
-                              method = cv2.cv.CV_CONTOURS_MATCH_I2):
-        #method can also be cv2.cv.CV_CONTOURS_MATCH_I1 or I3
-        self.make_contour()
-        another_cv_char.make_contour()
-        return cv2.matchShapes(self.cnt, another_cv_char.cnt, method, 0)
-
-    def vassert(self, expr):
-        if not expr:
-            print "About to fail on", self.filename
-        assert(expr)
-
-    def make_contour(self):
-        if self.cnt is not None:
-            return
-
-        self.img = cv2.imread(str(self.filename), cv2.IMREAD_GRAYSCALE)
-
-        self.vassert(self.img is not None)
-        self.vassert(self.img.data)
-
-        contours, hierarchy = cv2.findContours(self.img, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-        self.cnt = contours[-1]
-
-        self.vassert(self.cnt is not None)
-        self.vassert(len(self.cnt))
-
-        del self.img
-        self.img = None
-        return
+# matchShapes ignores any Hu moment whose magnitude is at or below this
+HU_EPS = 1.e-5
+NUM_HU_MOMENTS = 7
+
+# ways of getting the shape features of a character:
+# from the contour of a rendered image, or straight from the font's outlines
+FEATURE_ENGINE_RASTER = "raster"
+FEATURE_ENGINE_OUTLINE = "outline"
+
+# line segments per bezier curve when flattening outlines
+OUTLINE_CURVE_STEPS = 16
+
+# describes how raster features are extracted; cached features are only reused if this matches
+RASTER_FEATURE_PARAMS = "findContours(RETR_TREE, CHAIN_APPROX_NONE)[-1] -> log10 HuMoments v1"
+
+
+# the signed log of each Hu moment of a contour, the way cv2.matchShapes sees them.
+# moments too small to count are NaN so that they drop out of any comparison
+def log_hu_moments(cnt):
+    return log_scaled(cv2.HuMoments(cv2.moments(cnt)).flatten())
+
+
+def log_scaled(hu):
+    ret = numpy.empty(NUM_HU_MOMENTS)
+    ret.fill(numpy.nan)
+    big = numpy.abs(hu) > HU_EPS
+    ret[big] = numpy.sign(hu[big]) * numpy.log10(numpy.abs(hu[big]))
+    return ret
+
+
+# spatial moments (up to 3rd order) of the area enclosed by some polygons, the way
+# cv2.moments computes them for a contour.  polygons wound the opposite way subtract (holes)
+def polygon_moments(polygons):
+    m = dict((k, 0.0) for k in ["m00", "m10", "m01", "m20", "m11", "m02", "m30", "m21", "m12", "m03"])
+    for poly in polygons:
+        x0 = poly[:, 0]
+        y0 = poly[:, 1]
+        x1 = numpy.roll(x0, -1)
+        y1 = numpy.roll(y0, -1)
+        a = x0 * y1 - x1 * y0
+        m["m00"] += a.sum() / 2.0
+        m["m10"] += (a * (x0 + x1)).sum() / 6.0
+        m["m01"] += (a * (y0 + y1)).sum() / 6.0
+        m["m20"] += (a * (x0 * x0 + x0 * x1 + x1 * x1)).sum() / 12.0
+        m["m11"] += (a * (x0 * (2 * y0 + y1) + x1 * (y0 + 2 * y1))).sum() / 24.0
+        m["m02"] += (a * (y0 * y0 + y0 * y1 + y1 * y1)).sum() / 12.0
+        m["m30"] += (a * (x0 + x1) * (x0 * x0 + x1 * x1)).sum() / 20.0
+        m["m21"] += (a * (x0 * x0 * (3 * y0 + y1) + 2 * x0 * x1 * (y0 + y1) + x1 * x1 * (y0 + 3 * y1))).sum() / 60.0
+        m["m12"] += (a * (y0 * y0 * (3 * x0 + x1) + 2 * y0 * y1 * (x0 + x1) + y1 * y1 * (x0 + 3 * x1))).sum() / 60.0
+        m["m03"] += (a * (y0 + y1) * (y0 * y0 + y1 * y1)).sum() / 20.0
+
+    # outer contours may be wound either way depending on the font format
+    if m["m00"] < 0:
+        for k in m:
+            m[k] = -m[k]
+    return m
+
+
+# the seven Hu moments from spatial moments (same formulas as cv2.HuMoments)
+def hu_moments_of(m):
+    cx = m["m10"] / m["m00"]
+    cy = m["m01"] / m["m00"]
+    mu20 = m["m20"] - cx * m["m10"]
+    mu11 = m["m11"] - cx * m["m01"]
+    mu02 = m["m02"] - cy * m["m01"]
+    mu30 = m["m30"] - cx * (3 * mu20 + cx * m["m10"])
+    mu21 = m["m21"] - cx * (2 * mu11 + cx * m["m01"]) - cy * mu20
+    mu12 = m["m12"] - cy * (2 * mu11 + cy * m["m10"]) - cx * mu02
+    mu03 = m["m03"] - cy * (3 * mu02 + cy * m["m01"])
+
+    s2 = m["m00"] ** 2
+    s3 = m["m00"] ** 2.5
+    n20, n11, n02 = mu20 / s2, mu11 / s2, mu02 / s2
+    n30, n21, n12, n03 = mu30 / s3, mu21 / s3, mu12 / s3, mu03 / s3
+
+    t0 = n30 + n12
+    t1 = n21 + n03
+    q0 = n30 - 3 * n12
+    q1 = 3 * n21 - n03
+    return numpy.array([
+        n20 + n02,
+        (n20 - n02) ** 2 + 4 * n11 ** 2,
+        q0 ** 2 + q1 ** 2,
+        t0 ** 2 + t1 ** 2,
+        q0 * t0 * (t0 ** 2 - 3 * t1 ** 2) + q1 * t1 * (3 * t0 ** 2 - t1 ** 2),
+        (n20 - n02) * (t0 ** 2 - t1 ** 2) + 4 * n11 * t0 * t1,
+        q1 * t0 * (t0 ** 2 - 3 * t1 ** 2) - q0 * t1 * (3 * t0 ** 2 - t1 ** 2),
+    ])
+
+
+# cv2.matchShapes on log Hu moments, broadcast over every axis but the last.
+# hu_distance(a, b) == cv2.matchShapes(cnt_a, cnt_b, method, 0) for single contours
+def hu_distance(ma, mb, method=cv2.cv.CV_CONTOURS_MATCH_I2):
+    valid = ~(numpy.isnan(ma) | numpy.isnan(mb))
+    ma = numpy.where(valid, ma, 1.0)
+    mb = numpy.where(valid, mb, 1.0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        if method == cv2.cv.CV_CONTOURS_MATCH_I1:
+            terms = numpy.abs(1.0 / ma - 1.0 / mb)
+        elif method == cv2.cv.CV_CONTOURS_MATCH_I2:
+            terms = numpy.abs(ma - mb)
+        elif method == cv2.cv.CV_CONTOURS_MATCH_I3:
+            terms = numpy.abs((ma - mb) / ma)
+        else:
+            raise ValueError("Unknown contour match method %s" % method)
+    terms = numpy.where(valid, terms, 0.0)
+
+    if method == cv2.cv.CV_CONTOURS_MATCH_I3:
+        return terms.max(axis=-1)
+    return terms.sum(axis=-1)
+
+
+# the contour that characters are compared by (the last one findContours finds), or None
+def image_contour(img):
+    contours, hierarchy = cv2.findContours(img, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+    return contours[-1] if len(contours) else None
+
+
+# the contour of a character image (PIL or numpy), without going through a file
+def image_char_contour(img):
+    arr = (numpy.asarray(img) != 0).astype(numpy.uint8) * numpy.uint8(255)
+    cnt = image_contour(arr)
+    if cnt is None or not len(cnt):
+        raise ValueError("character image has no contour")
+    return cnt
+
+
+# log Hu moments straight from a character image
+def image_hu_moments(img):
+    return log_hu_moments(image_char_contour(img))
+
+
+# A pen that flattens glyph outlines (TrueType or CFF) into closed polygons
+class FlatteningPen(BasePen):
+    def __init__(self, glyph_set):
+        BasePen.__init__(self, glyph_set)
+        self.polygons = []
+        self.points = None
+
+    def _moveTo(self, pt):
+        self.points = [pt]
+
+    def _lineTo(self, pt):
+        self.points.append(pt)
+
+    def _curveToOne(self, pt1, pt2, pt3):
+        (x0, y0) = self._getCurrentPoint()
+        for t in numpy.linspace(0, 1, OUTLINE_CURVE_STEPS + 1)[1:]:
+            u = 1 - t
+            self.points.append((u ** 3 * x0 + 3 * u * u * t * pt1[0] + 3 * u * t * t * pt2[0] + t ** 3 * pt3[0],
+                                u ** 3 * y0 + 3 * u * u * t * pt1[1] + 3 * u * t * t * pt2[1] + t ** 3 * pt3[1]))
+
+    def _qCurveToOne(self, pt1, pt2):
+        (x0, y0) = self._getCurrentPoint()
+        for t in numpy.linspace(0, 1, OUTLINE_CURVE_STEPS + 1)[1:]:
+            u = 1 - t
+            self.points.append((u * u * x0 + 2 * u * t * pt1[0] + t * t * pt2[0],
+                                u * u * y0 + 2 * u * t * pt1[1] + t * t * pt2[1]))
+
+    def _closePath(self):
+        if self.points and 2 < len(self.points):
+            self.polygons.append(numpy.array(self.points, dtype=numpy.float64))
+        self.points = None
+
+    _endPath = _closePath
+
+
+# Shape features of characters computed straight from a font's outlines, without rasterizing.
+# Unlike the raster engine (which compares one contour of a rendered image), this uses the
+# whole filled shape of the glyph, at the font's full resolution
+class OutlineFont(object):
+    def __init__(self, fontfile):
+        self.font = ttLib.TTFont(fontfile, lazy=True, fontNumber=0)
+        self.cmap = self.font.getBestCmap() or {}
+        self.glyph_set = self.font.getGlyphSet()
+
+    def close(self):
+        self.font.close()
+
+    def has_char(self, char):
+        return ord(char) in self.cmap
+
+    # the glyph's outline as polygons, y-down like an image so that the reflection-sensitive
+    # 7th Hu moment has the same sign as in the raster engine
+    def polygons(self, char):
+        pen = FlatteningPen(self.glyph_set)
+        self.glyph_set[self.cmap[ord(char)]].draw(pen)
+        return [p * numpy.array([1.0, -1.0]) for p in pen.polygons]
+
+    def hu_moments(self, char):
+        m = polygon_moments(self.polygons(char))
+        if m["m00"] <= 0:
+            raise ValueError("character has no outline")
+        return log_scaled(hu_moments_of(m))
@@ -1,29 +1,130 @@
 from progress import DiscreteProgress
 from fontbank import FontBank
+from featurebank import FeatureBank, reduce_char_distances
+from knngraph import KNNGraph, KNN_DTYPE
+from cvfont import FEATURE_ENGINE_RASTER, FEATURE_ENGINE_OUTLINE
+from distancematrix import write_distance_matrix, read_distance_matrix, read_distance_file, read_distance_header
+from distancematrix import create_distance_file, finish_distance_file, num_pairs, CHAR_DISTANCES_DTYPE, KEY_CHARSET
 import string
 import json
+import hashlib
 import os
 
+import numpy
+
 JSON_OUTPUT_BASE_DIR = "report"
 JSON_OUTPUT_BASE_NAME = "distance_information_"
+CHECKPOINT_BASE_NAME = "distance_checkpoint_"
 KEY_FONTS = "fonts"
 KEY_DISTANCES = "distances"
+KEY_NEIGHBOURS = "neighbours"
+KEY_FONT_KEYS = "key"
+KEY_ENGINE = "engine"
+KEY_DIGEST = "digest"
+CHAR_DISTANCES_EXT = "_chars.bin"
+
+
+# font names (and paths) are utf-8 strs as read from the fonts, but come back from a JSON header
+# as unicode.  keep them all unicode, so cached and current fonts compare equal
+def as_unicode(s):
+    return s.decode("utf-8") if isinstance(s, bytes) else s
+
+# identifies a font info list: the digest of its fonts' keys, which cover their shapes too
+def fonts_digest(fonts):
+    return hashlib.sha1("\n".join(f[KEY_FONT_KEYS] for f in fonts).encode("utf-8")).hexdigest()
 
 # handles the caching and calculation of "distances" between fonts
 class DistanceBank(object):
 
-    def __init__(self, img_cache_dir, img_size):
+    # workers: number of processes to use for the expensive stages
+    # font_dirs: directory trees to find fonts in (None for the system font directories)
+    # dedupe_glyphs: compare only one of each set of fonts whose cached glyphs are identical
+    # engine: where character shapes come from (FEATURE_ENGINE_RASTER or FEATURE_ENGINE_OUTLINE)
+    # tile: side of the square tiles the distance matrix is split into (None to size them by memory)
+    # knn: instead of the full matrix, only find this many nearest neighbours of each font
+    # (a KNNGraph), for libraries too big to compare every pair of fonts.  None for the full matrix
+    # keep_contours: also keep a simplified copy of each glyph's contour in the feature cache
+    def __init__(self, img_cache_dir, img_size, workers=1, font_dirs=None, dedupe_glyphs=False,
+                 engine=FEATURE_ENGINE_RASTER, tile=None, knn=None, keep_contours=False):
         self.img_cache_dir = img_cache_dir
         self.img_size = img_size
+        self.workers = workers
+        self.font_dirs = font_dirs
+        self.dedupe_glyphs = dedupe_glyphs
+        self.engine = engine
+        self.tile = tile
+        self.knn = knn
+        self.keep_contours = keep_contours
 
-    # embed char set into filename
-    def get_filename(self, charset):
-        return os.path.join(JSON_OUTPUT_BASE_DIR, JSON_OUTPUT_BASE_NAME + charset + ".json")
+    # embed char set (and feature engine, if not the usual one) into filename
+    def get_filename(self, charset, ext=".json"):
+        engine = "" if FEATURE_ENGINE_RASTER == self.engine else "_" + self.engine
+        return os.path.join(JSON_OUTPUT_BASE_DIR, JSON_OUTPUT_BASE_NAME + charset + engine + ext)
+
+    # the binary (memory-mappable) copy of the distances
+    def get_matrix_filename(self, charset):
+        return self.get_filename(charset, ".bin")
+
+    # the nearest neighbour graph of a run
+    def get_knn_filename(self, charset):
+        return self.get_filename(charset, "_knn%d.bin" % self.knn)
+
+    # the per-character distances of a run
+    def get_char_distances_filename(self, charset):
+        return self.get_filename(charset, CHAR_DISTANCES_EXT)
+
+    # the per-character distances of a run, if they match the given fonts.  (header, array) or (None, None)
+    def read_char_distances(self, charset, fonts):
+        header, char_distances = read_distance_file(self.get_char_distances_filename(charset))
+        if header is None or [f.get(KEY_FONT_KEYS) for f in header[KEY_FONTS]] != [f.get(KEY_FONT_KEYS) for f in fonts]:
+            return None, None
+        return header, char_distances
+
+    # a run's per-character distances covering all the given characters, whatever charset it was for.
+    # fonts: only a run over exactly these fonts (and shapes) will do.
+    # (header, array) or (None, None)
+    def find_char_distances(self, chars, fonts):
+        digest = fonts_digest(fonts)
+        try:
+            names = sorted(os.listdir(JSON_OUTPUT_BASE_DIR))
+        except OSError:
+            return None, None
+        for name in names:
+            if not (name.startswith(JSON_OUTPUT_BASE_NAME) and name.endswith(CHAR_DISTANCES_EXT)):
+                continue
+            filename = os.path.join(JSON_OUTPUT_BASE_DIR, name)
+            header, _ = read_distance_header(filename)
+            if (header is not None and header.get(KEY_ENGINE) == self.engine
+                and all(c in header[KEY_CHARSET] for c in chars)
+                and (header.get(KEY_DIGEST) or fonts_digest(header[KEY_FONTS])) == digest):
+                return read_distance_file(filename)
+        return None, None
+
+    # distances for any weighting of the characters of an earlier run, without comparing any fonts.
+    # weights: dict of character -> how much it counts.  returns the font info list and matrix,
+    # or (None, None) if no run over these fonts covered those characters.
+    # fonts: the font info list the run has to be over
+    def get_weighted_distances(self, weights, fonts):
+        chars = [c for c, w in weights.items() if w]
+        header, char_distances = self.find_char_distances(chars, fonts)
+        if header is None:
+            return None, None
+        indices = [header[KEY_CHARSET].index(c) for c in chars]
+        fonts = header[KEY_FONTS]
+        return fonts, reduce_char_distances(char_distances, len(fonts), indices, [weights[c] for c in chars])
+
+    # where a distance run in progress keeps its finished tiles (without extension)
+    def get_checkpoint_path(self, charset):
+        engine = "" if FEATURE_ENGINE_RASTER == self.engine else "_" + self.engine
+        return os.path.join(self.img_cache_dir, CHECKPOINT_BASE_NAME + charset + engine)
+
+    # the cached font info list and distances (as a memory-mapped array), or (None, None).
+    # distances that were only ever exported as JSON are converted to the binary format
+    def read_distances(self, charset):
+        matrix = read_distance_matrix(self.get_matrix_filename(charset))
+        if matrix is not None and matrix[0] == charset:
+            return matrix[1], matrix[2]
 
-    # get a font info list, and a matrix of distances between fonts (aligned indexes)
-    # this is an expensive thing to calculate.
-    # so, make sure results are cached and return them
-    def get_distances(self, charset):
         fonts = None
         distances = None
         try:
@@ -35,68 +136,183 @@ class DistanceBank(object):
             print "DistanceBank.get_distances error:", e
 
         if fonts is None or distances is None:
+            return None, None
+        write_distance_matrix(self.get_matrix_filename(charset), charset, fonts, distances)
+        return fonts, read_distance_matrix(self.get_matrix_filename(charset))[2]
+
+    # get a font info list, and a matrix (2d array) of distances between fonts (aligned indexes),
+    # or in knn mode, a KNNGraph of each font's nearest neighbours.
+    # this is an expensive thing to calculate.
+    # so, make sure results are cached and return them.
+    # refresh: bring the cached distances up to date with the fonts installed now
+    # (only fonts that were added or changed get compared)
+    # a charset that's part of one compared before is worked out from its per-character distances,
+    # if that run was over the fonts installed now
+    def get_distances(self, charset, refresh=False):
+        if self.knn is not None:
+            return self.get_knn_graph(charset, refresh)
+
+        fonts, distances = self.read_distances(charset)
+        if refresh or fonts is None or distances is None:
             fonts, distances = self.cache_distances(charset)
 
         return fonts, distances
 
-    # pull valid fonts (the non-null fonts) from a font bank
-    def get_valid_fonts(self, font_bank):
-        valid_fonts = []
-        for f in font_bank.font_set:
-            name = font_bank.font_name[f]
-            font = font_bank.get_font(name)
-            if font_bank.successful_caches[f]:
-                if font.is_null():
-                    print "is null font:", name
-                else:
-                    valid_fonts.append(f)
-        return valid_fonts
-
-    # construct a 2d array of font distances, aligned keys with valid_fonts
-    def get_font_distances(self, valid_fonts, font_bank):
-        fb = font_bank
-
-        # font distance matrix
-        distances = [[(0 if i == j else None) for i, __ in enumerate(valid_fonts)] for j, _ in enumerate(valid_fonts)]
-        print distances
-        prog = DiscreteProgress(0.0001)
-        n = len(valid_fonts)
-        prog.begin_task("comparing", (n * (n - 1)) / 2, "Comparing distances between %d fonts" % n)
-        for i in range(len(valid_fonts)):
-            a = valid_fonts[i]
-            name_a = fb.font_name[a]
-            print name_a
-            for j in range(i + 1, len(valid_fonts)):
-                b = valid_fonts[j]
-                name_b = fb.font_name[b]
-                #print name_a, "vs", name_b
-                dist = fb.get_font(name_a).distance_from(fb.get_font(name_b))
-                prog.advance(1)
-                distances[i][j] = dist
-                distances[j][i] = dist
-
-        prog.end_task("Completed successfully")
-        return distances
-
-    # calculate and cache distances pulled from a font bank
+    # work out (and cache) the distances for a charset from the per-character distances of an
+    # earlier run covering it, without comparing any fonts.  (font info list, matrix), or (None, None).
+    # fonts: the font info list the run has to be over
+    def reduce_distances(self, charset, fonts):
+        fonts, distances = self.get_weighted_distances(dict((c, 1.0) for c in charset), fonts)
+        if fonts is None:
+            return None, None
+        print "Distances for %s worked out from per-character distances" % charset
+        write_distance_matrix(self.get_matrix_filename(charset), charset, fonts, distances)
+        self.export_json(charset, fonts, distances)
+        return fonts, distances
+
+    # pull valid fonts (the non-null fonts) from a font bank's features
+    def get_valid_fonts(self, font_bank, feature_bank):
+        valid = []
+        for i, null in enumerate(feature_bank.null_fonts()):
+            if null:
+                print "is null font:", font_bank.font_name[feature_bank.font_files[i]]
+            else:
+                valid.append(i)
+        return feature_bank.subset(valid)
+
+    # construct a 2d array of font distances, aligned keys with the feature bank's fonts.
+    # an interrupted run resumes from its checkpoint, as long as the fonts and charset are the same.
+    # if distances were cached before, only fonts that aren't in them are compared
+    # font_keys: identifies each font (and its shapes), to match it up with the cached fonts
+    # char_distances: an array to fill with condensed per-character distances (None to not keep them)
+    def get_font_distances(self, feature_bank, font_keys=None, char_distances=None):
+        charset = feature_bank.char_set
+        old_fonts, old_distances = self.read_distances(charset)
+        old_char_distances = None
+        if old_fonts is not None and char_distances is not None:
+            _, old_char_distances = self.read_char_distances(charset, old_fonts)
+
+        usable = old_fonts is not None and old_distances is not None
+        if font_keys is not None and usable and (char_distances is None or old_char_distances is not None):
+            old_rows = dict((f.get(KEY_FONT_KEYS), i) for i, f in enumerate(old_fonts))
+            rows = [old_rows.get(k, -1) for k in font_keys]
+            num_kept = len(rows) - rows.count(-1)
+            num_new = len(rows) - num_kept
+
+            # updating compares the new fonts serially; only worth it if that's less work than
+            # each worker's share of comparing everything again
+            if num_kept and num_pairs(len(rows)) < num_new * len(rows) * max(1, self.workers):
+                print "Only %d of %d fonts have cached distances; comparing them all again" % (num_kept, len(rows))
+            elif num_kept:
+                print "Reusing distances between %d of %d fonts (%d dropped)" % (num_kept, len(rows), len(old_fonts) - num_kept)
+                return feature_bank.update_distances(rows, old_distances, DiscreteProgress(0.01),
+                                                     old_char_distances=old_char_distances,
+                                                     char_distances=char_distances)
+
+        return feature_bank.distances(DiscreteProgress(0.01), workers=self.workers, tile=self.tile,
+                                      checkpoint=self.get_checkpoint_path(charset), char_distances=char_distances)
+
+    # the cached font info list and nearest neighbour graph, or (None, None)
+    def read_knn_graph(self, charset):
+        header, records = read_distance_file(self.get_knn_filename(charset))
+        if header is None or header[KEY_CHARSET] != charset:
+            return None, None
+        return header[KEY_FONTS], KNNGraph.from_records(records)
+
+    # the cached nearest neighbour graph (or a new one)
+    def get_knn_graph(self, charset, refresh=False):
+        if not refresh:
+            fonts, graph = self.read_knn_graph(charset)
+            if fonts is not None:
+                return fonts, graph
+        return self.cache_knn_graph(charset)
+
+    # find and cache the nearest neighbours of fonts from a font bank.
+    # if the fonts are the same as the cached graph's, that graph is kept
+    def cache_knn_graph(self, charset):
+        valid_features, out_fonts, _ = self.load_features(charset)
+        old_fonts, old_graph = self.read_knn_graph(charset)
+        if old_fonts == out_fonts:
+            print "Nearest neighbours of %d fonts are up to date" % len(out_fonts)
+            return old_fonts, old_graph
+
+        graph = valid_features.knn_graph(DiscreteProgress(0.1), self.knn)
+
+        filename = self.get_knn_filename(charset)
+        records = create_distance_file(filename, charset, out_fonts, graph.indices.shape, KNN_DTYPE,
+                                       **{KEY_ENGINE: self.engine})
+        records[:] = graph.to_records()
+        finish_distance_file(filename, records)
+
+        with open(self.get_filename(charset, "_knn%d.json" % self.knn), "w") as outfile:
+            json.dump({
+                "charset": charset,
+                KEY_FONTS: out_fonts,
+                KEY_NEIGHBOURS: [graph.neighbours(i) for i in range(len(graph))]
+            }, outfile)
+        return out_fonts, graph
+
+    # calculate and cache distances pulled from a font bank.
+    # if the fonts are the same as the cached distances', nothing is compared or rewritten
     def cache_distances(self, charset):
-        fb = FontBank(self.img_cache_dir, self.img_size, charset, DiscreteProgress(0.1))
+        valid_features, out_fonts, font_keys = self.load_features(charset)
+        old_fonts, old_distances = self.read_distances(charset)
+        if old_fonts == out_fonts and self.read_char_distances(charset, old_fonts)[0] is not None:
+            print "Distances between %d fonts are up to date" % len(out_fonts)
+            return old_fonts, old_distances
+
+        # a run over the same fonts whose charset covers this one needs no comparing either
+        reduced_fonts, reduced = self.reduce_distances(charset, out_fonts)
+        if reduced_fonts is not None:
+            return reduced_fonts, reduced
 
-        valid_fonts = self.get_valid_fonts(fb)
-        distances = self.get_font_distances(valid_fonts, fb)
+        # keep the per-character distances too, so other charsets can be worked out from them
+        chars_filename = self.get_char_distances_filename(charset)
+        char_distances = create_distance_file(chars_filename, charset, out_fonts,
+                                              (num_pairs(len(out_fonts)), len(charset)), CHAR_DISTANCES_DTYPE,
+                                              **{KEY_ENGINE: self.engine, KEY_DIGEST: fonts_digest(out_fonts)})
+        distances = self.get_font_distances(valid_features, font_keys, char_distances)
+        finish_distance_file(chars_filename, char_distances)
 
         # cache the results
+        write_distance_matrix(self.get_matrix_filename(charset), charset, out_fonts, distances)
+        self.export_json(charset, out_fonts, distances)
+        return out_fonts, distances
+
+    # the features of the valid fonts in a font bank, their font info list, and their keys
+    def load_features(self, charset):
+        fb = FontBank(self.img_cache_dir, self.img_size, charset, DiscreteProgress(0.1), self.workers,
+                      font_dirs=self.font_dirs, render_glyphs=(FEATURE_ENGINE_RASTER == self.engine),
+                      keep_contours=self.keep_contours)
+
+        cached_fonts = [f for f in fb.font_set if fb.successful_caches[f]]
+        glyph_aliases = {}
+        if self.dedupe_glyphs and FEATURE_ENGINE_RASTER == self.engine:
+            cached_fonts, glyph_aliases = fb.dedupe_by_glyphs(cached_fonts)
+            print "%d fonts have the same glyphs as another font" % sum(map(len, glyph_aliases.values()))
+
+        features = FeatureBank(fb, cached_fonts, DiscreteProgress(0.1), self.engine)
+
+        valid_features = self.get_valid_fonts(fb, features)
+        valid_fonts = valid_features.font_files
+        font_keys = [as_unicode(fb.font_name[f]) + ":" + d for f, d in zip(valid_fonts, valid_features.row_digests())]
+
+        # fonts that were collapsed as duplicates are listed with the one they matched
         out_fonts = [{
-            "name": fb.font_name[f],
-            "family": fb.font_family[f],
-            "subfamily": fb.font_subfamily[f]
-        } for f in valid_fonts]
+            "name": as_unicode(fb.font_name[f]),
+            "family": as_unicode(fb.font_family[f]),
+            "subfamily": as_unicode(fb.font_subfamily[f]),
+            "files": [as_unicode(a) for g in [f] + glyph_aliases.get(f, []) for a in fb.font_files(g)],
+            "aliases": [as_unicode(fb.font_name[g]) for g in glyph_aliases.get(f, [])],
+            KEY_FONT_KEYS: k
+        } for f, k in zip(valid_fonts, font_keys)]
+        return valid_features, out_fonts, font_keys
 
+    # write the distances out as JSON, for the report
+    def export_json(self, charset, fonts, distances):
         with open(self.get_filename(charset), "w") as outfile:
             json.dump({
                 "charset": charset,
-                KEY_FONTS: out_fonts,
-                KEY_DISTANCES: distances
+                KEY_FONTS: fonts,
+                KEY_DISTANCES: numpy.asarray(distances).tolist()
             }, outfile)
-
-        return out_fonts, distances
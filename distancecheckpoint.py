@@ -0,0 +1,136 @@
+import os
+import json
+import time
+
+import numpy
+from numpy.lib import format as npformat
+
+from distancematrix import num_pairs, put_condensed, CHAR_DISTANCES_DTYPE
+
+CHECKPOINT_INDEX_EXT = ".json"
+CHECKPOINT_MATRIX_EXT = ".npy"
+CHECKPOINT_DONE_EXT = "_done.npy"
+CHECKPOINT_CHARS_EXT = "_chars.npy"
+KEY_KEY = "key"
+KEY_SIZE = "size"
+KEY_TILES = "tiles"
+KEY_CHARS = "chars"
+
+# how often to make finished tiles durable
+CHECKPOINT_SECONDS = 60
+
+
+# The partly-computed distance matrix of a long run, kept on disk so that a run that dies can
+# pick up where it left off.  The matrix is a memory-mapped file, with a mask of which tiles of
+# it are finished (and optionally, the condensed per-character distances).  Tiles are only
+# marked finished once their distances have been flushed, so a run killed at any point never
+# resumes with a half-written tile.
+#
+# The checkpoint is only resumed if its key matches (the key should cover everything the
+# distances depend on: the fonts' features, the distance method and the tiling).
+# Otherwise it is started over
+class DistanceCheckpoint(object):
+
+    # base_path: filename of the checkpoint, without extension
+    # key: a string identifying the computation
+    # n: number of fonts
+    # num_tiles: number of tiles the computation is split into
+    # n_chars: number of characters to keep per-character distances of (None to not keep them)
+    def __init__(self, base_path, key, n, num_tiles, n_chars=None):
+        self.base_path = base_path
+        self.key = key
+        self.n = n
+        self.num_tiles = num_tiles
+        self.n_chars = n_chars
+        self.matrix = None
+        self.done = None
+        self.chars = None
+        self.pending = []
+        self.last_flush = time.time()
+        self.open()
+
+    def filename(self, ext):
+        return self.base_path + ext
+
+    def read_index(self):
+        try:
+            with open(self.filename(CHECKPOINT_INDEX_EXT)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def open(self):
+        index = self.read_index()
+        if (index is not None
+            and index[KEY_KEY] == self.key
+            and index[KEY_SIZE] == self.n
+            and index[KEY_TILES] == self.num_tiles
+            and index.get(KEY_CHARS) == self.n_chars):
+            try:
+                self.matrix = numpy.load(self.filename(CHECKPOINT_MATRIX_EXT), mmap_mode="r+")
+                self.done = numpy.load(self.filename(CHECKPOINT_DONE_EXT), mmap_mode="r+")
+                if self.n_chars is not None:
+                    self.chars = numpy.load(self.filename(CHECKPOINT_CHARS_EXT), mmap_mode="r+")
+                if self.matrix.shape == (self.n, self.n) and self.done.shape == (self.num_tiles,):
+                    return
+            except (IOError, ValueError):
+                pass
+
+        self.create()
+
+    # start over.  the index is written last, so a checkpoint is never valid until it's all there
+    def create(self):
+        self.remove()
+        self.matrix = npformat.open_memmap(self.filename(CHECKPOINT_MATRIX_EXT), mode="w+",
+                                           dtype=numpy.float64, shape=(self.n, self.n))
+        self.done = npformat.open_memmap(self.filename(CHECKPOINT_DONE_EXT), mode="w+",
+                                         dtype=numpy.bool_, shape=(self.num_tiles,))
+        self.done[:] = False
+        if self.n_chars is not None:
+            self.chars = npformat.open_memmap(self.filename(CHECKPOINT_CHARS_EXT), mode="w+",
+                                              dtype=CHAR_DISTANCES_DTYPE, shape=(num_pairs(self.n), self.n_chars))
+        self.flush()
+        with open(self.filename(CHECKPOINT_INDEX_EXT), "w") as f:
+            json.dump({KEY_KEY: self.key, KEY_SIZE: self.n, KEY_TILES: self.num_tiles, KEY_CHARS: self.n_chars}, f)
+
+    # how many tiles are already finished
+    def num_done(self):
+        return int(self.done.sum())
+
+    def is_done(self, t):
+        return bool(self.done[t])
+
+    # store the distances of tile number t, whose corner is at (i0, j0)
+    # char_block: the tile's per-character distances, if they're being kept
+    def put(self, t, i0, j0, block, char_block=None):
+        self.matrix[i0:i0 + block.shape[0], j0:j0 + block.shape[1]] = block
+        if self.chars is not None:
+            put_condensed(self.chars, self.n, i0, j0, char_block)
+        self.pending.append(t)
+        if CHECKPOINT_SECONDS < time.time() - self.last_flush:
+            self.flush()
+
+    # make the stored tiles durable, then mark them finished
+    def flush(self):
+        self.matrix.flush()
+        if self.chars is not None:
+            self.chars.flush()
+        for t in self.pending:
+            self.done[t] = True
+        self.done.flush()
+        self.pending = []
+        self.last_flush = time.time()
+
+    # the finished matrix, in memory
+    def result(self):
+        self.flush()
+        return numpy.array(self.matrix)
+
+    # delete the checkpoint from disk
+    def remove(self):
+        self.matrix = None
+        self.done = None
+        self.chars = None
+        for ext in [CHECKPOINT_INDEX_EXT, CHECKPOINT_MATRIX_EXT, CHECKPOINT_DONE_EXT, CHECKPOINT_CHARS_EXT]:
+            if os.path.exists(self.filename(ext)):
+                os.remove(self.filename(ext))
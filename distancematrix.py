@@ -0,0 +1,124 @@
+import os
+import json
+
+import numpy
+
+# A distance file is one line of magic, one line of JSON header (the charset, the font
+# info list, the array's shape and dtype, and anything else), then the raw array, starting at
+# an aligned offset.  The whole array can be memory-mapped without reading or parsing any of it.
+#
+# Distance matrices are (n_fonts, n_fonts) float64.  Per-character distances are condensed:
+# one float32 row per pair of fonts (i < j, in row-major order), one column per character
+DISTANCE_MATRIX_MAGIC = "FONTCLUSTR DISTANCES 1\n"
+DISTANCE_MATRIX_ALIGN = 64
+DISTANCE_MATRIX_DTYPE = "<f8"
+CHAR_DISTANCES_DTYPE = "<f4"
+KEY_CHARSET = "charset"
+KEY_FONTS = "fonts"
+KEY_SHAPE = "shape"
+KEY_DTYPE = "dtype"
+
+
+# number of pairs of n fonts
+def num_pairs(n):
+    return n * (n - 1) / 2
+
+# row of the pair (i, j) in a condensed array, for i < j (works on arrays too)
+def condensed_index(n, i, j):
+    return n * i - i * (i + 1) / 2 + (j - i - 1)
+
+# store a tile of per-pair values (rows i0.., columns j0..) into a condensed array,
+# skipping the pairs that aren't above the diagonal
+def put_condensed(condensed, n, i0, j0, block):
+    for r in range(block.shape[0]):
+        i = i0 + r
+        j = max(j0, i + 1)
+        if j < j0 + block.shape[1]:
+            start = condensed_index(n, i, j)
+            condensed[start:start + j0 + block.shape[1] - j] = block[r, j - j0:]
+
+
+# the dtype of a distance file's array (JSON turns a record dtype's fields into lists)
+def header_dtype(header):
+    dtype = header[KEY_DTYPE]
+    if isinstance(dtype, list):
+        dtype = [tuple(field) for field in dtype]
+    return numpy.dtype(dtype)
+
+
+# start writing a distance file.  returns a writable memory-mapped array to fill in, which
+# becomes the file once finish_distance_file is called
+def create_distance_file(filename, charset, fonts, shape, dtype=DISTANCE_MATRIX_DTYPE, **extra):
+    header = dict(extra)
+    header.update({
+        KEY_CHARSET: charset,
+        KEY_FONTS: fonts,
+        KEY_SHAPE: list(shape),
+        KEY_DTYPE: dtype
+    })
+    header = json.dumps(header)
+    used = len(DISTANCE_MATRIX_MAGIC) + len(header) + 1
+    header += " " * (-used % DISTANCE_MATRIX_ALIGN) + "\n"
+
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(DISTANCE_MATRIX_MAGIC)
+        f.write(header)
+        offset = f.tell()
+        f.truncate(offset + numpy.dtype(dtype).itemsize * int(numpy.prod(shape, dtype=numpy.int64)))
+    if 0 == numpy.prod(shape):
+        return numpy.zeros(shape, dtype=dtype)
+    return numpy.memmap(tmp_filename, dtype=dtype, mode="r+", offset=offset, shape=shape)
+
+# replace any old distance file with the one being written.
+# it's written in full first, so a reader never sees a half-written file
+def finish_distance_file(filename, array):
+    if isinstance(array, numpy.memmap):
+        array.flush()
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(filename + ".tmp", filename)
+
+
+# write a distance matrix and what it's for
+def write_distance_matrix(filename, charset, fonts, distances):
+    distances = numpy.asarray(distances, dtype=DISTANCE_MATRIX_DTYPE)
+    out = create_distance_file(filename, charset, fonts, distances.shape)
+    out[:] = distances
+    finish_distance_file(filename, out)
+
+
+# the header of a distance file, and the offset of its array, or (None, None) if there's no valid file
+def read_distance_header(filename):
+    try:
+        with open(filename, "rb") as f:
+            if f.readline() != DISTANCE_MATRIX_MAGIC:
+                return None, None
+            header = json.loads(f.readline())
+            offset = f.tell()
+    except (IOError, ValueError):
+        return None, None
+
+    size = header_dtype(header).itemsize * numpy.prod(header[KEY_SHAPE], dtype=numpy.int64)
+    if os.path.getsize(filename) != offset + size:
+        return None, None
+    return header, offset
+
+# the header of a distance file and its read-only memory-mapped array, or (None, None)
+def read_distance_file(filename):
+    header, offset = read_distance_header(filename)
+    if header is None:
+        return None, None
+
+    shape = tuple(header[KEY_SHAPE])
+    dtype = header_dtype(header)
+    if 0 == numpy.prod(shape):
+        return header, numpy.zeros(shape, dtype=dtype)
+    return header, numpy.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+# (charset, font info list, read-only memory-mapped matrix), or None if there's no valid file
+def read_distance_matrix(filename):
+    header, distances = read_distance_file(filename)
+    if header is None:
+        return None
+    return header[KEY_CHARSET], header[KEY_FONTS], distances
@@ -0,0 +1,358 @@
+import math
+import hashlib
+import multiprocessing
+
+import cv2
+import numpy
+
+from cvfont import NUM_HU_MOMENTS, hu_distance, FEATURE_ENGINE_RASTER, FEATURE_ENGINE_OUTLINE, OutlineFont
+from distancecheckpoint import DistanceCheckpoint
+from distancematrix import condensed_index, put_condensed, CHAR_DISTANCES_DTYPE
+from knngraph import KNNGraph, rp_tree_leaves
+
+# rough cap on the scratch space used by one tile of the all-pairs computation
+DISTANCE_BLOCK_BYTES = 64 * 1024 * 1024
+# how many copies of its (pairs, chars, moments) input hu_distance holds at its peak (the
+# masked copies of both sides, their difference, its absolute value and the validity mask come
+# to a little over 4), and likewise summed_char_distances of its (pairs, chars) input
+HU_DISTANCE_TEMPORARIES = 5
+SUMMED_DISTANCE_TEMPORARIES = 3
+
+# defaults for the approximate nearest neighbour search: more trees, bigger leaves and more
+# refinement passes find more of the true neighbours, and take longer
+KNN_TREES = 8
+KNN_LEAF_SIZE = 64
+KNN_REFINE_PASSES = 1
+
+
+# per-character distances between two sets of fonts, as an (a, b, chars) array.
+# characters missing from either font of a pair are NaN
+def font_char_distances(features_a, present_a, features_b, present_b, method=cv2.cv.CV_CONTOURS_MATCH_I2):
+    per_char = hu_distance(features_a[:, None], features_b[None, :], method)
+    shared = present_a[:, None] & present_b[None, :]
+    return numpy.where(shared, per_char, numpy.nan)
+
+# sum per-character distances (..., chars) into font distances.  characters missing from
+# either font of a pair are left out and the sum is scaled up to the full charset;
+# pairs with no characters in common are NaN.
+# weights: how much each character counts (None for all the same)
+def summed_char_distances(per_char, weights=None):
+    if weights is None:
+        weights = numpy.ones(per_char.shape[-1])
+    shared = ~numpy.isnan(per_char)
+    total = numpy.where(shared, per_char * weights, 0.0).sum(axis=-1)
+    shared_weight = (shared * weights).sum(axis=-1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        scaled = total * (numpy.sum(weights) / shared_weight.astype(float))
+    return numpy.where(0 < shared_weight, scaled, numpy.nan)
+
+# summed per-character distances between two sets of fonts, as an (a, b) array
+def font_distances(features_a, present_a, features_b, present_b, method=cv2.cv.CV_CONTOURS_MATCH_I2):
+    return summed_char_distances(font_char_distances(features_a, present_a, features_b, present_b, method))
+
+# the (n, n) matrix of font distances from condensed per-character distances.
+# chars: indices of the characters to use; weights: how much each of them counts.
+# fonts with no characters in common are given the largest distance found
+def reduce_char_distances(char_distances, n, chars, weights=None):
+    chars = numpy.asarray(chars)
+    ret = numpy.zeros((n, n))
+    rows = max(1, DISTANCE_BLOCK_BYTES / max(1, len(chars) * 8 * SUMMED_DISTANCE_TEMPORARIES))
+    summed = numpy.empty(len(char_distances))
+    for start in range(0, len(char_distances), rows):
+        stop = min(len(char_distances), start + rows)
+        summed[start:stop] = summed_char_distances(numpy.asarray(char_distances[start:stop])[:, chars], weights)
+    for i in range(n - 1):
+        start = condensed_index(n, i, i + 1)
+        ret[i, i + 1:] = summed[start:start + n - i - 1]
+    ret = ret + ret.T
+    disjoint = numpy.isnan(ret)
+    if disjoint.any():
+        ret[disjoint] = numpy.nanmax(ret) if not disjoint.all() else 0
+    return ret
+
+
+# worker processes get the features to compare once, set by the pool initializer
+_worker_features = None
+
+def _init_distance_worker(features, present, method, keep_chars=False):
+    global _worker_features
+    _worker_features = (features, present, method, keep_chars)
+
+# distances for one numbered tile of the matrix: rows [i0, i1) against columns [j0, j1),
+# and the per-character distances if they're being kept
+def _tile_distances(numbered_tile):
+    f, p, method, keep_chars = _worker_features
+    t, (i0, i1, j0, j1) = numbered_tile
+    per_char = font_char_distances(f[i0:i1], p[i0:i1], f[j0:j1], p[j0:j1], method)
+    return t, summed_char_distances(per_char), per_char.astype(CHAR_DISTANCES_DTYPE) if keep_chars else None
+
+
+# The distance between two fonts only depends on the Hu moments of their character contours.
+# This class extracts those moments once per (font, char) into an (n_fonts, n_chars, 7) array
+# so that the distance matrix can be computed in bulk instead of one matchShapes call at a time.
+# Characters a font has no glyph for are marked absent in an (n_fonts, n_chars) mask
+class FeatureBank(object):
+
+    # font_bank: a FontBank whose characters are already cached
+    # font_files: the fonts (keys of font_bank.font_set) to extract, in row order
+    # engine: FEATURE_ENGINE_RASTER (from cached glyph images) or FEATURE_ENGINE_OUTLINE (from font outlines)
+    def __init__(self, font_bank, font_files, progress, engine=FEATURE_ENGINE_RASTER):
+        self.char_set = font_bank.char_set
+        self.font_files = list(font_files)
+        self.features = None
+        self.present = None
+        self.extract(font_bank, progress, engine)
+
+    def extract(self, font_bank, progress, engine):
+        n = len(self.font_files)
+        self.features = numpy.empty((n, len(self.char_set), NUM_HU_MOMENTS))
+        self.features.fill(numpy.nan)
+        self.present = numpy.ones((n, len(self.char_set)), dtype=numpy.bool_)
+
+        progress.begin_task("features", n, "Extracting %s features from %d fonts" % (engine, n))
+        for i, f in enumerate(self.font_files):
+            missing = font_bank.missing_chars(f)
+            if FEATURE_ENGINE_OUTLINE == engine:
+                self.extract_outlines(i, f, missing)
+            elif FEATURE_ENGINE_RASTER == engine:
+                self.extract_raster(i, font_bank.font_name[f], missing, font_bank)
+            else:
+                raise ValueError("Unknown feature engine %s" % engine)
+            progress.advance(1)
+        if FEATURE_ENGINE_RASTER == engine:
+            font_bank.atlas.flush()
+            font_bank.feature_cache.save()
+        progress.end_task("Extracted %d features" % self.present.sum())
+
+    # features from the contours of cached glyph images
+    def extract_raster(self, i, font_name, missing, font_bank):
+        for j, c in enumerate(self.char_set):
+            if c in missing:
+                self.present[i, j] = False
+            else:
+                self.features[i, j] = font_bank.get_char_features(font_name, c)
+
+    # features from the font file's outlines; characters whose outlines can't be read are left out
+    def extract_outlines(self, i, font_file, missing):
+        outlines = OutlineFont(font_file)
+        for j, c in enumerate(self.char_set):
+            try:
+                if c in missing or not outlines.has_char(c):
+                    raise KeyError(c)
+                self.features[i, j] = outlines.hu_moments(c)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.present[i, j] = False
+        outlines.close()
+
+    # a new FeatureBank holding only the given rows (in the given order)
+    def subset(self, indices):
+        ret = FeatureBank.__new__(FeatureBank)
+        ret.char_set = self.char_set
+        ret.font_files = [self.font_files[i] for i in indices]
+        ret.features = self.features[indices]
+        ret.present = self.present[indices]
+        return ret
+
+    # boolean array: whether every character of a font has the same shape as the first one it has
+    def null_fonts(self, method=cv2.cv.CV_CONTOURS_MATCH_I2):
+        f = self.features
+        p = self.present
+        first = f[numpy.arange(len(f)), p.argmax(axis=1)]
+        same = hu_distance(first[:, None], f, method) <= 0
+        return numpy.all(same | ~p, axis=1) | ~p.any(axis=1)
+
+    # the side of the largest square tile of the matrix whose scratch space (mostly hu_distance's
+    # temporaries) fits in DISTANCE_BLOCK_BYTES
+    def tile_size(self):
+        _, n_chars, n_moments = self.features.shape
+        pair_bytes = max(1, n_chars * n_moments * self.features.itemsize * HU_DISTANCE_TEMPORARIES)
+        return max(1, int(math.sqrt(DISTANCE_BLOCK_BYTES / pair_bytes)))
+
+    # square tiles covering the upper triangle of the matrix, as (i0, i1, j0, j1)
+    def tiles(self, tile):
+        n = len(self.features)
+        starts = range(0, n, tile)
+        return [(i, min(n, i + tile), j, min(n, j + tile)) for i in starts for j in starts if i <= j]
+
+    # identifies a distance computation: anything that changes the fonts, their features,
+    # the method or the tiling gives a different key
+    def distance_key(self, method, tile):
+        h = hashlib.sha1()
+        h.update(repr((method, tile, self.char_set, self.features.shape)))
+        h.update(numpy.ascontiguousarray(self.features).tobytes())
+        h.update(numpy.ascontiguousarray(self.present).tobytes())
+        return h.hexdigest()
+
+    # the (n_fonts, n_fonts) matrix of summed per-character contour distances.
+    # matches summing cv2.matchShapes over the charset for the upper triangle, mirrored into the lower one.
+    # fonts with no characters in common are given the largest distance found.
+    # workers: number of processes to compare tiles in (1 compares in this process)
+    # tile: side of the square tiles of the matrix to compare at once (None to fit DISTANCE_BLOCK_BYTES)
+    # checkpoint: where to keep finished tiles, so an interrupted run can resume (None to not keep them)
+    # char_distances: a writable (n_pairs, n_chars) array to fill with condensed per-character
+    # distances, NaN where a pair doesn't share a character (None to not keep them)
+    def distances(self, progress, method=cv2.cv.CV_CONTOURS_MATCH_I2, workers=1, tile=None, checkpoint=None,
+                  char_distances=None):
+        n = len(self.features)
+        tile = tile or self.tile_size()
+        tiles = self.tiles(tile)
+        keep_chars = char_distances is not None
+
+        saved = None
+        if checkpoint is not None:
+            saved = DistanceCheckpoint(checkpoint, self.distance_key(method, tile), n, len(tiles),
+                                       len(self.char_set) if keep_chars else None)
+            ret = saved.matrix
+            todo = [t for t in range(len(tiles)) if not saved.is_done(t)]
+            if len(todo) < len(tiles):
+                print "Resuming from checkpoint: %d of %d tiles already compared" % (len(tiles) - len(todo), len(tiles))
+        else:
+            ret = numpy.zeros((n, n))
+            todo = range(len(tiles))
+
+        def store(t, block, char_block):
+            i0, _, j0, _ = tiles[t]
+            if saved is None:
+                ret[i0:i0 + block.shape[0], j0:j0 + block.shape[1]] = block
+                if keep_chars:
+                    put_condensed(char_distances, n, i0, j0, char_block)
+            else:
+                saved.put(t, i0, j0, block, char_block)
+            progress.advance(1)
+
+        worker_args = (self.features, self.present, method, keep_chars)
+        progress.begin_task("comparing", len(todo), "Comparing distances between %d fonts (%d tiles)" % (n, len(todo)))
+        if 1 < workers and 1 < len(todo):
+            pool = multiprocessing.Pool(workers, _init_distance_worker, worker_args)
+            try:
+                for result in pool.imap_unordered(_tile_distances, [(t, tiles[t]) for t in todo]):
+                    store(*result)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            _init_distance_worker(*worker_args)
+            for t in todo:
+                store(*_tile_distances((t, tiles[t])))
+        progress.end_task("Completed successfully")
+
+        if saved is not None:
+            ret = saved.result()
+            if keep_chars:
+                rows = max(1, DISTANCE_BLOCK_BYTES / max(1, len(self.char_set) * 4))
+                for start in range(0, len(char_distances), rows):
+                    char_distances[start:start + rows] = saved.chars[start:start + rows]
+            saved.remove()
+
+        upper = numpy.triu(ret, 1)
+        return self.fill_disjoint(upper + upper.T)
+
+    # give pairs of fonts with no characters in common the largest distance found
+    def fill_disjoint(self, ret):
+        shared = numpy.dot(self.present.astype(numpy.int32), self.present.T.astype(numpy.int32))
+        disjoint = 0 == shared
+        numpy.fill_diagonal(disjoint, False)
+        if disjoint.any():
+            ret[disjoint] = numpy.nan
+            ret[disjoint] = numpy.nanmax(ret) if not disjoint.all() else 0
+        return ret
+
+    # each font's features as one flat vector, for finding candidate neighbours
+    # (the distance between fonts is roughly the L1 distance between these)
+    def feature_vectors(self):
+        f = numpy.where(self.present[:, :, None] & ~numpy.isnan(self.features), self.features, 0.0)
+        return f.reshape(len(f), -1)
+
+    # the k nearest neighbours of every font, without comparing every pair of fonts.
+    # candidates come from the leaves of random projection trees (fonts that share a leaf are
+    # compared exactly), then from neighbours of neighbours.
+    # trees, leaf_size, refine_passes: trade speed for finding more of the true neighbours
+    def knn_graph(self, progress, k, method=cv2.cv.CV_CONTOURS_MATCH_I2, trees=KNN_TREES, leaf_size=KNN_LEAF_SIZE,
+                  refine_passes=KNN_REFINE_PASSES, seed=0):
+        f = self.features
+        p = self.present
+        n = len(f)
+        graph = KNNGraph.empty(n, k)
+        points = self.feature_vectors()
+        rng = numpy.random.RandomState(seed)
+        leaf_size = max(leaf_size, k + 1)
+
+        progress.begin_task("neighbours", trees + refine_passes, "Finding %d nearest neighbours of %d fonts" % (k, n))
+        for _ in range(trees):
+            for leaf in rp_tree_leaves(points, leaf_size, rng):
+                block = font_distances(f[leaf], p[leaf], f[leaf], p[leaf], method)
+                graph.merge(leaf, numpy.tile(leaf, (len(leaf), 1)), block)
+            progress.advance(1)
+
+        # (rows, k * k, chars, 7) at a time
+        _, n_chars, n_moments = f.shape
+        rows = max(1, DISTANCE_BLOCK_BYTES / max(1, k * k * n_chars * n_moments * f.itemsize))
+        for _ in range(refine_passes):
+            for start in range(0, n, rows):
+                chunk = numpy.arange(start, min(n, start + rows))
+                near = graph.indices[chunk]
+                cands = numpy.where(near[:, :, None] < 0, -1, graph.indices[near]).reshape(len(chunk), -1)
+                safe = numpy.maximum(cands, 0)
+                per_char = hu_distance(f[chunk][:, None], f[safe], method)
+                shared = p[chunk][:, None] & p[safe]
+                graph.merge(chunk, cands, summed_char_distances(numpy.where(shared, per_char, numpy.nan)))
+            progress.advance(1)
+        progress.end_task("Found %d neighbours" % (0 <= graph.indices).sum())
+        return graph
+
+    # a digest of each font's features, so rows can be matched up with an earlier matrix
+    def row_digests(self):
+        return [hashlib.sha1(numpy.ascontiguousarray(self.features[i]).tobytes()
+                             + numpy.ascontiguousarray(self.present[i]).tobytes()).hexdigest()
+                for i in range(len(self.features))]
+
+    # the distance matrix, reusing an earlier one: only rows of fonts that weren't in it are
+    # compared (against every font), and rows of fonts that are gone are dropped.
+    # old_rows: for each font, its row in old_distances (or -1 if it's new)
+    # old_char_distances, char_distances: the earlier condensed per-character distances, and an
+    # array to fill with the new ones (see distances), or None to not keep them
+    def update_distances(self, old_rows, old_distances, progress, method=cv2.cv.CV_CONTOURS_MATCH_I2,
+                         old_char_distances=None, char_distances=None):
+        f = self.features
+        p = self.present
+        n = len(f)
+        old_rows = numpy.asarray(old_rows, dtype=numpy.intp).reshape(n)
+        kept = numpy.flatnonzero(0 <= old_rows)
+        new = numpy.flatnonzero(old_rows < 0)
+        keep_chars = char_distances is not None
+
+        ret = numpy.zeros((n, n))
+        ret[numpy.ix_(kept, kept)] = numpy.asarray(old_distances)[numpy.ix_(old_rows[kept], old_rows[kept])]
+
+        if keep_chars:
+            n_old = len(old_distances)
+            for i in kept[:-1]:
+                later = kept[kept > i]
+                a = numpy.minimum(old_rows[i], old_rows[later])
+                b = numpy.maximum(old_rows[i], old_rows[later])
+                char_distances[condensed_index(n, i, later)] = old_char_distances[condensed_index(n_old, a, b)]
+
+        # (rows, chars, 7) vs (n, chars, 7) at a time
+        _, n_chars, n_moments = f.shape
+        rows = max(1, DISTANCE_BLOCK_BYTES / max(1, n * n_chars * n_moments * f.itemsize * HU_DISTANCE_TEMPORARIES))
+        progress.begin_task("comparing", len(new), "Comparing %d new fonts against %d fonts" % (len(new), n))
+        for start in range(0, len(new), rows):
+            chunk = new[start:start + rows]
+            per_char = font_char_distances(f[chunk], p[chunk], f, p, method)
+            block = summed_char_distances(per_char)
+            ret[chunk, :] = block
+            ret[:, chunk] = block.T
+            if keep_chars:
+                others = numpy.arange(n)
+                for r, i in enumerate(chunk):
+                    js = others[others != i]
+                    pairs = condensed_index(n, numpy.minimum(i, js), numpy.maximum(i, js))
+                    char_distances[pairs] = per_char[r, js]
+            progress.advance(len(chunk))
+        progress.end_task("Kept distances between %d fonts" % len(kept))
+
+        numpy.fill_diagonal(ret, 0)
+        return self.fill_disjoint(ret)
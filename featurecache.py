@@ -0,0 +1,85 @@
+import os
+import hashlib
+
+import cv2
+import numpy
+
+from cvfont import NUM_HU_MOMENTS, RASTER_FEATURE_PARAMS
+
+KEY_KEYS = "keys"
+KEY_FEATURES = "features"
+KEY_CONTOUR_KEYS = "contour_keys"
+KEY_CONTOUR_POINTS = "contour_points"
+KEY_CONTOUR_OFFSETS = "contour_offsets"
+
+
+# Contour features of glyph images, keyed by a hash of the image and of how the features
+# were extracted.  Any glyph that has been seen before (in any font, in any run) never has its
+# contour extracted again.  The whole cache is loaded at once and saved as one .npz file.
+# Optionally, a simplified copy of each contour is kept as well
+class FeatureCache(object):
+
+    # keep_contours: also keep contours, simplified to within contour_epsilon pixels
+    def __init__(self, filename, keep_contours=False, contour_epsilon=1.0):
+        self.filename = filename
+        self.keep_contours = keep_contours
+        self.contour_epsilon = contour_epsilon
+        self.features = {}
+        self.contours = {}
+        self.dirty = False
+        self.load()
+
+    # the cache key for a glyph image (e.g. its packed bytes in the glyph atlas)
+    def key(self, glyph_bytes):
+        return hashlib.sha1(RASTER_FEATURE_PARAMS + glyph_bytes).hexdigest()
+
+    def load(self):
+        try:
+            data = numpy.load(self.filename)
+        except (IOError, ValueError):
+            return
+
+        self.features = dict(zip(data[KEY_KEYS].tolist(), data[KEY_FEATURES]))
+        if KEY_CONTOUR_KEYS in data:
+            points = data[KEY_CONTOUR_POINTS]
+            offsets = data[KEY_CONTOUR_OFFSETS]
+            for i, k in enumerate(data[KEY_CONTOUR_KEYS].tolist()):
+                self.contours[k] = points[offsets[i]:offsets[i + 1]]
+        data.close()
+        print "Loaded features of %d glyphs" % len(self.features)
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        keys = sorted(self.features.keys())
+        arrays = {
+            KEY_KEYS: numpy.array(keys),
+            KEY_FEATURES: numpy.array([self.features[k] for k in keys]).reshape(-1, NUM_HU_MOMENTS)
+        }
+        if self.contours:
+            contour_keys = sorted(self.contours.keys())
+            contours = [self.contours[k].reshape(-1, 2) for k in contour_keys]
+            arrays[KEY_CONTOUR_KEYS] = numpy.array(contour_keys)
+            arrays[KEY_CONTOUR_POINTS] = numpy.concatenate(contours).astype(numpy.int32)
+            arrays[KEY_CONTOUR_OFFSETS] = numpy.cumsum([0] + [len(c) for c in contours])
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            numpy.savez(f, **arrays)
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp_filename, self.filename)
+        self.dirty = False
+
+    def get(self, key):
+        return self.features.get(key)
+
+    def get_contour(self, key):
+        return self.contours.get(key)
+
+    def put(self, key, features, cnt=None):
+        self.features[key] = numpy.asarray(features)
+        if self.keep_contours and cnt is not None:
+            self.contours[key] = cv2.approxPolyDP(cnt, self.contour_epsilon, True).reshape(-1, 2)
+        self.dirty = True
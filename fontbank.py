@@ -2,12 +2,17 @@ import os
 import sys
 import errno
 import pickle
+import hashlib
+import multiprocessing
+from StringIO import StringIO
 
-from matplotlib import font_manager
 from fontTools import ttLib
 from PIL import Image, ImageFont, ImageDraw
 
-from cvfont import CVFont, CVChar
+from cvfont import image_char_contour, log_hu_moments
+from glyphatlas import GlyphAtlas
+from fontfinder import FontFinder
+from featurecache import FeatureCache
 
 # makes a directory even if it's already there
 def mkdir(path):
@@ -17,9 +22,80 @@ def mkdir(path):
         if err.errno != errno.EEXIST:
             raise
 
+# a digest of a file's contents
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            h.update(block)
+    return h.hexdigest()
+
+# get the typeface name and family names from a font file.
+# tables are loaded lazily, so only the name table gets parsed
+def font_info(fontfile):
+    FAMILY_ID = 1
+    SUBFAMILY_ID = 2
+    NAME_ID = 4
+    PREFERRED_FAMILY_ID = 16
+
+    def decoded(val):
+        if '\000' in val:
+            return unicode(val, 'utf-16-be').encode('utf-8')
+        return unicode(val)
+
+    font = ttLib.TTFont(fontfile, lazy=True, fontNumber=0)
+    name = ""
+    family = ""
+    subfamily = ""
+    preferred_family = ""
+    for record in font['name'].names:
+        if record.langID not in [0, 1033]: continue
+
+        if record.nameID == NAME_ID and not name:
+            name = decoded(record.string)
+        elif record.nameID == FAMILY_ID and not family:
+            family = decoded(record.string)
+        elif record.nameID == SUBFAMILY_ID and not subfamily:
+            subfamily = decoded(record.string)
+        elif record.nameID == PREFERRED_FAMILY_ID and not preferred_family:
+            preferred_family = decoded(record.string)
+    font.close()
+
+    # some fonts apparently have wrong names in field 1 and correct names in field 16
+    return name, (preferred_family if preferred_family else family), subfamily
+
+
+# characters that a font file has no glyph for, according to its cmap.
+# if the cmap can't be read, assume everything is there and let rendering sort it out
+def font_missing_chars(fontfile, chars):
+    try:
+        font = ttLib.TTFont(fontfile, lazy=True, fontNumber=0)
+        cmap = font.getBestCmap()
+        font.close()
+    except:
+        return []
+
+    if not cmap:
+        return []
+    return [c for c in chars if ord(c) not in cmap]
+
+
+# (path, size, mtime): enough to tell whether cached information about a file is still good
+def file_identity(path):
+    st = os.stat(path)
+    return (path, st.st_size, st.st_mtime)
+
 FONTBANK_PICKLE_FILE = "fontbank.pkl"
+FONTINFO_PICKLE_FILE = "fontinfo.pkl"
+FONTDIGEST_PICKLE_FILE = "fontdigests.pkl"
+FONTDIRS_PICKLE_FILE = "fontdirs.pkl"
+FEATURE_CACHE_FILE = "glyphfeatures.npz"
+ATLAS_BASE_NAME = "atlas_"
 CHAR_IMG_EXT = "png"
 
+# the cache result for a character that the font doesn't have
+MISSING_GLYPH = "missing glyph"
+
 # If a character renders to a blank image
 class BlankChar(Exception):
     pass
@@ -29,16 +105,123 @@ class InvalidRender(Exception):
     pass
 
 
+# Renders characters from one font file.  The file is read once, and the face is only
+# set up once for each size that gets asked for, no matter how many characters are rendered
+class RenderSession(object):
+    def __init__(self, font_file):
+        self.font_file = font_file
+        self.font_data = None
+        self.faces = {}
+
+    # the face at a given pixel size
+    def get_face(self, size):
+        if size not in self.faces:
+            try:
+                if self.font_data is None:
+                    with open(self.font_file, "rb") as f:
+                        self.font_data = f.read()
+                self.faces[size] = ImageFont.truetype(StringIO(self.font_data), size)
+            except:
+                raise InvalidRender()
+        return self.faces[size]
+
+    #create a white-on-black image of a character in the given font, double-sized
+    def render(self, char, img_size):
+        image = Image.new("1", (img_size, img_size), 0)
+        usr_font = self.get_face(img_size / 2)
+        d_usr = ImageDraw.Draw(image)
+        d_usr.fontmode = "1" # this apparently sets (anti)aliasing.
+        d_usr.text((0, 0), char, 1, font=usr_font)
+
+        return image
+
+    # crop an image, centering the character based on bounding box, single-sized
+    def center(self, img, img_size):
+        # get bounding box (left, top, right, bottom) and determine width and height (wd/ht)
+        bb = img.getbbox()
+        if None is bb:
+            raise BlankChar
+        (bb_l, bb_t, bb_r, bb_b) = bb
+        wd = bb_r - bb_l
+        ht = bb_b - bb_t
+
+        # contour generation will fail if the character touches the edge of the image,
+        # so crop with a 1px border in mind.  so cropped image size = img_size - 2
+        cis2 = img_size - 2
+        if cis2 <= wd or cis2 <= ht:
+            # crop aggressively, determine new bounds (nb)
+            nb_l = bb_l - ((cis2 - wd) / 2)
+            nb_t = bb_t - ((cis2 - ht) / 2)
+            nb_r = nb_l + cis2
+            nb_b = nb_t + cis2
+            bb = (nb_l, nb_t, nb_r, nb_b)
+
+        # crop to bounding box, then uncrop to center it
+        img = img.crop(bb)
+        (bb_l, bb_t, bb_r, bb_b) = bb
+        wd = bb_r - bb_l
+        ht = bb_b - bb_t
+
+        # offsets will be negative
+        nb_l = (wd - img_size) / 2
+        nb_t = (ht - img_size) / 2
+        nb_r = nb_l + img_size
+        nb_b = nb_t + img_size
+
+        img = img.crop((nb_l, nb_t, nb_r, nb_b))
+
+        return img
+
+    # render a character and center it in an img_size square
+    def render_centered(self, char, img_size):
+        return self.center(self.render(char, img_size), img_size)
+
+
+# worker processes get their own copy of the font bank, set once by the pool initializer.
+# the atlas is mapped again from its files in the worker (a forked copy shares the parent's
+# mapping, but a pickled one would be a private copy), so rendered glyphs reach the parent
+_worker_font_bank = None
+
+def _init_cache_worker(font_bank):
+    global _worker_font_bank
+    _worker_font_bank = font_bank
+    _worker_font_bank.atlas.load_layers()
+
+# render a group of same-named fonts in order, so dupe detection matches the serial path
+def _cache_font_group(fonts):
+    processed_names = {}
+    ret = []
+    for font in fonts:
+        dupe_of, outcomes = _worker_font_bank.render_one_font(font, processed_names)
+        if dupe_of is None and all(o is None for o in outcomes):
+            processed_names[_worker_font_bank.font_name[font]] = font
+        ret.append((font, dupe_of, outcomes))
+    return ret
+
+
 # FontClustr works on a set of typefaces, and compares them using a set of characters.
 # These operations are backed by a set of images cached on disk.
 # This class manages the repositiory of cache-backed typeface objects
 class FontBank(object):
-    def __init__(self, cache_dir, img_size, char_set, progress):
+    # workers: number of processes to render with (1 renders in this process)
+    # hash_fonts: whether to detect changed font files by content, not just size and mtime
+    # font_dirs: directory trees to find fonts in (None for the system font directories)
+    # render_glyphs: whether to render glyph images (not needed if features come from outlines)
+    # keep_contours: also keep a simplified copy of each glyph's contour in the feature cache
+    # export_images: also write each cached glyph out as an image file (for the HTML reports)
+    def __init__(self, cache_dir, img_size, char_set, progress, workers=1, hash_fonts=False, font_dirs=None,
+                 render_glyphs=True, keep_contours=False, export_images=False):
         # private vars
         self.cache_dir = cache_dir
         self.img_size = img_size
         self.char_set = char_set
         self.progress = progress
+        self.workers = workers
+        self.hash_fonts = hash_fonts
+        self.font_dirs = font_dirs
+        self.render_glyphs = render_glyphs
+        self.keep_contours = keep_contours
+        self.export_images = export_images
 
         # computed stuff
         self.font_set = None
@@ -47,6 +230,11 @@ class FontBank(object):
         self.font_subfamily = None
         self.successful_caches = None
         self.successful_caches_names = None
+        self.manifest = None
+        self.char_results = None
+        self.font_aliases = None
+        self.atlas = None
+        self.feature_cache = None
         self.unpickle_or_process()
 
 
@@ -62,19 +250,27 @@ class FontBank(object):
              self.font_family,
              self.font_subfamily,
              self.successful_caches,
-             self.successful_caches_names) = pickle.load(pkl_file)
+             self.successful_caches_names,
+             self.manifest,
+             self.char_results,
+             self.font_aliases) = pickle.load(pkl_file)
             pkl_file.close()
             print "  Loaded fontbank from pickle!"
-            if set(char_set) == set(self.char_set):
-                pkl_valid = True
-            else:
-                print "  Pickled charset differs from current!"
+            pkl_valid = True
         except:
             pass
 
-        if not pkl_valid:
+        if pkl_valid:
+            charset_changed = set(char_set) != set(self.char_set)
+            if charset_changed:
+                print "  Pickled charset differs from current, caching the difference"
+            changed = self.refresh_fontbank(charset_changed)
+        else:
             print "Pickle FAIL... build data and cache it"
             self.build_fontbank()
+            changed = True
+
+        if changed:
             output = open(pkl_filename, 'wb')
             pickle.dump((self.char_set,
                          self.font_set,
@@ -82,168 +278,415 @@ class FontBank(object):
                          self.font_family,
                          self.font_subfamily,
                          self.successful_caches,
-                         self.successful_caches_names), output, -1)
+                         self.successful_caches_names,
+                         self.manifest,
+                         self.char_results,
+                         self.font_aliases), output, -1)
             output.close()
             print "Pickled fontbank for next time"
 
+        # fonts cached before images were asked for don't have them yet
+        if self.export_images:
+            self.export_char_images(overwrite=False)
+
+    # the font files to work on
+    def find_fonts(self):
+        mkdir(self.cache_dir)
+        finder = FontFinder(self.font_dirs, os.path.join(self.cache_dir, FONTDIRS_PICKLE_FILE))
+        return finder.find()
+
     def build_fontbank(self):
         # load fonts
-        self.font_set = font_manager.findSystemFonts(fontpaths=None, fontext="ttf")
+        self.font_set = self.dedupe_fonts(self.find_fonts())
         self.successful_caches = {}
         self.successful_caches_names = {}
+        self.manifest = {}
+        self.char_results = {}
 
         # initialize directory, process fonts
         mkdir(self.cache_dir)
         self.font_name = {}
         self.font_family = {}
         self.font_subfamily = {}
+        self.load_font_info(self.font_set)
+
+        self.open_atlas()
+        self.cache_all_fonts(self.font_set)
+        self.atlas.flush()
+
+
+    # bring a pickled font bank up to date with the font files on disk and the charset,
+    # only rendering fonts that were added or changed and characters that were never tried.
+    # returns whether anything changed
+    def refresh_fontbank(self, charset_changed):
+        old_aliases = self.font_aliases
+        found = self.dedupe_fonts(self.find_fonts())
+        found_set = set(found)
+        old_set = set(self.font_set)
+        removed = [f for f in self.font_set if f not in found_set]
+        changed = [f for f in self.font_set if f in found_set and self.font_changed(f)]
+        added = [f for f in found if f not in old_set]
+
+        # a replay re-records every font, but only renders what isn't cached yet
+        replay = charset_changed
+        if not (removed or changed or added or replay):
+            self.open_atlas()
+            unrendered = []
+            if self.render_glyphs:
+                unrendered = [f for f in self.font_set if self.successful_caches[f] and self.needs_render(f)]
+            if not unrendered:
+                print "  Fontbank is up to date"
+                return old_aliases != self.font_aliases
+
+            # a previous run only needed outlines
+            print "  %d fonts only have outline results; rendering them for raster features" % len(unrendered)
+            replay = True
+        else:
+            if charset_changed:
+                print "  Character set changed; replaying every font"
+            print "  Fonts changed on disk: %d added, %d changed, %d removed" % (len(added), len(changed), len(removed))
+
+        # names whose cached glyphs came from (or may have come from) a stale font.
+        # those names get re-rendered from whichever fonts still provide them
+        stale = removed + changed
+        stale_names = set()
+        for f in stale:
+            name = self.font_name[f]
+            if self.successful_caches_names.get(name, f) == f:
+                stale_names.add(name)
+
+        for f in stale:
+            self.forget_font(f)
+        for name in stale_names:
+            self.successful_caches_names.pop(name, None)
         for f in self.font_set:
-            data = self.fontInfo(f)
+            if f in self.font_name and self.font_name[f] in stale_names:
+                self.char_results.pop(f, None)
+
+        self.font_set = found
+        self.load_font_info(added + changed)
+
+        fresh = set(added + changed)
+        redo = [f for f in self.font_set if f in fresh or self.font_name[f] in stale_names]
+        for f in redo:
+            self.successful_caches.pop(f, None)
+
+        # whether a font succeeds (and so, which font wins its name) depends on the charset.
+        # fonts whose characters were all tried before will just replay their results
+        if replay:
+            redo = list(self.font_set)
+            self.successful_caches = {}
+            self.successful_caches_names = {}
+
+        self.open_atlas()
+        for name in stale_names:
+            if name in self.atlas.font_index:
+                self.atlas.clear(name)
+        self.cache_all_fonts(redo)
+        self.atlas.flush()
+        return True
+
+
+    # read the names of some fonts and record their file signatures
+    def load_font_info(self, fonts):
+        info = self.cached_map(FONTINFO_PICKLE_FILE, font_info, fonts, set(self.font_set), "Reading names of")
+        for f in fonts:
+            data = info[f]
             self.font_name[f] = data[0]
             self.font_family[f] = data[1]
             self.font_subfamily[f] = data[2]
+            self.manifest[f] = self.font_signature(f)
+
+
+    # collapse byte-identical font files (e.g. the same font installed in several places).
+    # the first copy is kept, and the rest are listed under it in font_aliases
+    def dedupe_fonts(self, fonts):
+        digests = self.cached_map(FONTDIGEST_PICKLE_FILE, file_digest, fonts, set(fonts), "Hashing")
+        first = {}
+        unique = []
+        self.font_aliases = {}
+        for f in fonts:
+            d = digests[f]
+            if d in first:
+                self.font_aliases.setdefault(first[d], []).append(f)
+            else:
+                first[d] = f
+                unique.append(f)
+
+        if len(unique) < len(fonts):
+            print "  %d of %d font files are copies of others" % (len(fonts) - len(unique), len(fonts))
+        return unique
+
+
+    # collapse fonts whose cached glyphs are identical (e.g. renamed copies of the same outlines).
+    # returns the unique fonts, and a dict of font -> the other fonts that look exactly like it
+    def dedupe_by_glyphs(self, fonts):
+        first = {}
+        unique = []
+        aliases = {}
+        for f in fonts:
+            d = self.atlas.glyph_digest(self.font_name[f], self.char_set)
+            if d in first:
+                aliases.setdefault(first[d], []).append(f)
+            else:
+                first[d] = f
+                unique.append(f)
+        return unique, aliases
 
-        self.cache_all_fonts()
 
+    # all the files that a font in the font set stands for
+    def font_files(self, font):
+        return [font] + self.font_aliases.get(font, [])
+
+
+    # apply a module-level function to some font files, caching results by file identity.
+    # fonts not in the cache are done in parallel.  returns a dict of font -> result
+    # keep_paths: files worth remembering in the cache (the rest are forgotten)
+    def cached_map(self, cache_filename, fn, fonts, keep_paths, description):
+        cache_filename = os.path.join(self.cache_dir, cache_filename)
+        try:
+            with open(cache_filename, "rb") as f:
+                cache = pickle.load(f)
+        except:
+            cache = {}
 
-    # Cache all fonts, and mark as cached
-    def cache_all_fonts(self):
-        steps = len(self.font_set) * len(self.char_set)
-        self.progress.begin_task("cacheing", steps, "Caching %d characters (%d fonts)" % (steps, len(self.font_set)))
+        identities = dict((f, file_identity(f)) for f in fonts)
+        todo = [f for f in fonts if identities[f] not in cache]
+        if todo:
+            print "%s %d fonts (%d already known)" % (description, len(todo), len(fonts) - len(todo))
+            for f, result in zip(todo, self.map_fonts(fn, todo)):
+                cache[identities[f]] = result
 
-        for font in self.font_set:
-            self.cache_one_font(font)
+            keep = dict((k, v) for k, v in cache.items() if k[0] in keep_paths)
+            with open(cache_filename, "wb") as f:
+                pickle.dump(keep, f, -1)
 
-        num_successful = self.successful_caches.values().count(True)
-        self.progress.end_task("Successfully cached %d of %d fonts" % (num_successful, len(self.font_set)))
+        return dict((f, cache[identities[f]]) for f in fonts)
+
+
+    # apply a module-level function to a list of font files, in parallel if we have workers
+    def map_fonts(self, fn, fonts):
+        if 1 >= self.workers or 1 >= len(fonts):
+            return [fn(f) for f in fonts]
+
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            chunksize = max(1, len(fonts) / (self.workers * 4))
+            ret = pool.map(fn, fonts, chunksize)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return ret
+
+
+    # remove all record of a font
+    def forget_font(self, font):
+        for d in [self.font_name, self.font_family, self.font_subfamily, self.successful_caches,
+                  self.manifest, self.char_results]:
+            d.pop(font, None)
+
+
+    # (size, mtime, content hash) of a font file.  hashing is optional since it reads the whole file
+    def font_signature(self, font_file):
+        st = os.stat(font_file)
+        return (st.st_size, st.st_mtime, file_digest(font_file) if self.hash_fonts else None)
+
+
+    # whether a font file differs from the one in the manifest
+    def font_changed(self, font_file):
+        (size, mtime, digest) = self.manifest[font_file]
+        st = os.stat(font_file)
+        if (st.st_size, st.st_mtime) == (size, mtime):
+            return False
+        if digest is None or digest != file_digest(font_file):
+            return True
+
+        # touched, but the contents are the same
+        self.manifest[font_file] = (st.st_size, st.st_mtime, digest)
+        return False
+
+
+    # open (or lay out) the glyph atlas for the current font set, and load the feature cache.
+    # it keeps the glyphs of characters outside the current charset, in case they come back
+    def open_atlas(self):
+        if self.feature_cache is None:
+            self.feature_cache = FeatureCache(os.path.join(self.cache_dir, FEATURE_CACHE_FILE), self.keep_contours)
+
+        font_names = []
+        seen = set()
+        for f in self.font_set:
+            if self.font_name[f] not in seen:
+                seen.add(self.font_name[f])
+                font_names.append(self.font_name[f])
+        self.atlas = GlyphAtlas(self.get_atlas_path(), self.img_size, self.char_set, font_names)
+
+
+    # Cache some fonts, and mark as cached
+    def cache_all_fonts(self, fonts):
+        steps = len(fonts) * len(self.char_set)
+        self.progress.begin_task("cacheing", steps, "Caching %d characters (%d fonts)" % (steps, len(fonts)))
+
+        if 1 < self.workers:
+            self.cache_fonts_parallel(fonts)
+        else:
+            for font in fonts:
+                self.cache_one_font(font)
+
+        self.save_feature_cache(fonts)
+        if self.export_images:
+            self.export_char_images([self.font_name[f] for f in fonts if self.successful_caches[f]])
+        num_successful = [self.successful_caches[f] for f in fonts].count(True)
+        self.progress.end_task("Successfully cached %d of %d fonts" % (num_successful, len(fonts)))
+
+
+    # Cache fonts across a pool of processes.  Fonts sharing a name go to the same worker
+    # (and write to the same cache dir), so each group is rendered in order just like the serial path
+    def cache_fonts_parallel(self, fonts):
+        groups = {}
+        group_order = []
+        for font in fonts:
+            font_name = self.font_name[font]
+
+            # names that are already cached can only produce dupes, and fonts
+            # with nothing left to render will only replay results; no need for a worker
+            if font_name in self.successful_caches_names or not self.needs_render(font):
+                self.cache_one_font(font)
+                continue
+
+            if font_name not in groups:
+                groups[font_name] = []
+                group_order.append(font_name)
+            groups[font_name].append(font)
+
+        # workers map the atlas from disk, so it has to be up to date there first
+        self.atlas.flush()
+        pool = multiprocessing.Pool(self.workers, _init_cache_worker, (self,))
+        try:
+            jobs = [groups[name] for name in group_order]
+            for results in pool.imap_unordered(_cache_font_group, jobs):
+                for font, dupe_of, outcomes in results:
+                    self.record_one_font(font, dupe_of, outcomes)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
 
     # Cache all characters of one font
     def cache_one_font(self, font):
+        dupe_of, outcomes = self.render_one_font(font, self.successful_caches_names)
+        self.record_one_font(font, dupe_of, outcomes)
+
+
+    # Render all characters of one font (unless its name was already processed).
+    # returns the font it duplicates (or None) and a list of error messages per char
+    # (None = success, MISSING_GLYPH = not in the font)
+    def render_one_font(self, font, processed_names):
         font_name = self.font_name[font]
 
         # detect dupes
-        if font_name in self.successful_caches_names:
-            self.progress.advance(1, font_name + " was already processed from " + self.successful_caches_names[font_name])
-            self.successful_caches[font] = False
-            return
+        if font_name in processed_names:
+            return processed_names[font_name], []
 
-        mkdir(self.get_cache_dirname(font_name))
+        # don't bother rendering the .notdef box for characters the font doesn't have
+        untried = [c for c in self.char_set if not self.char_known(font, c)]
+        missing = set(font_missing_chars(font, untried)) if untried else set()
 
+        session = RenderSession(font)
+        outcomes = []
         for char in self.char_set:
+            if self.char_known(font, char):
+                outcomes.append(self.char_results[font][char])
+                continue
+            if char in missing:
+                outcomes.append(MISSING_GLYPH)
+                continue
+            if not self.render_glyphs:
+                outcomes.append(None)
+                continue
+
             try:
-                self.cache_one_char(font, char)
+                self.cache_one_char(font, char, session)
             except KeyboardInterrupt:
                 raise
             except InvalidRender:
-                self.progress.advance(1, font_name + " character " + char + " can't render at this size")
-                self.successful_caches[font] = False
+                outcomes.append(font_name + " character " + char + " can't render at this size")
             except BlankChar:
-                self.progress.advance(1, font_name + " character " + char + " renders blank")
-                self.successful_caches[font] = False
+                outcomes.append(font_name + " character " + char + " renders blank")
             except:
-                self.progress.advance(1, "err on " + font_name + " was " + str(sys.exc_info()[0]))
-                self.successful_caches[font] = False
+                outcomes.append("err on " + font_name + " was " + str(sys.exc_info()[0]))
             else:
-                self.progress.advance(1)
+                outcomes.append(None)
+
+        return None, outcomes
+
+
+    # Record the results of render_one_font, and mark as cached
+    def record_one_font(self, font, dupe_of, outcomes):
+        font_name = self.font_name[font]
+
+        if dupe_of is not None:
+            self.progress.advance(1, font_name + " was already processed from " + dupe_of)
+            self.successful_caches[font] = False
+            return
+
+        # a missing glyph doesn't spoil the font; it's left out of comparisons instead
+        results = self.char_results.setdefault(font, {})
+        for char, error in zip(self.char_set, outcomes):
+            results[char] = error
+            if error == MISSING_GLYPH:
+                self.progress.advance(1, font_name + " has no glyph for character " + char)
+                continue
+            self.progress.advance(1, error)
+            if error is not None:
+                self.successful_caches[font] = False
+
+        # ... but a font with none of the characters has nothing to compare
+        if all(results[c] == MISSING_GLYPH for c in self.char_set):
+            self.successful_caches[font] = False
 
         if font not in self.successful_caches:
             self.successful_caches[font] = True
             self.successful_caches_names[font_name] = font
 
 
+    # whether a character of a font has been tried before (and if it worked, is still cached)
+    def char_known(self, font, char):
+        results = self.char_results.get(font, {})
+        if char not in results:
+            return False
+        return results[char] is not None or self.atlas.has(self.font_name[font], char)
+
+
+    # characters of the charset that a font doesn't have glyphs for
+    def missing_chars(self, font):
+        results = self.char_results.get(font, {})
+        return [c for c in self.char_set if results.get(c) == MISSING_GLYPH]
+
+
+    # whether any character of a font still needs to be tried
+    def needs_render(self, font):
+        return not all(self.char_known(font, c) for c in self.char_set)
+
+
     # Cache one of something
-    def cache_one_char(self, font_file, char):
+    def cache_one_char(self, font_file, char, session=None):
         font_name = self.font_name[font_file]
-        filename = self.get_cache_filename(font_name, char)
 
-        if os.path.exists(filename): return
+        if self.atlas.has(font_name, char): return
 
-        #create a white-on-black image of a character in the given font, double-sized
-        def char_render():
-            image = Image.new("1", (self.img_size, self.img_size), 0)
-            try:
-                usr_font = ImageFont.truetype(font_file, self.img_size / 2)
-            except:
-                raise InvalidRender()
-            d_usr = ImageDraw.Draw(image)
-            d_usr.fontmode = "1" # this apparently sets (anti)aliasing.
-            d_usr.text((0, 0), char, 1, font=usr_font)
-
-            return image
-
-
-        # crop an image, centering the character based on bounding box, single-sized
-        def char_center(img):
-            # get bounding box (left, top, right, bottom) and determine width and height (wd/ht)
-            bb = img.getbbox()
-            if None is bb:
-                raise BlankChar
-            (bb_l, bb_t, bb_r, bb_b) = bb
-            wd = bb_r - bb_l
-            ht = bb_b - bb_t
-
-            # contour generation will fail if the character touches the edge of the image,
-            # so crop with a 1px border in mind.  so cropped image size = img_size - 2
-            cis2 = self.img_size - 2
-            if cis2 <= wd or cis2 <= ht:
-                # crop aggressively, determine new bounds (nb)
-                nb_l = bb_l - ((cis2 - wd) / 2)
-                nb_t = bb_t - ((cis2 - ht) / 2)
-                nb_r = nb_l + cis2
-                nb_b = nb_t + cis2
-                bb = (nb_l, nb_t, nb_r, nb_b)
-
-            # crop to bounding box, then uncrop to center it
-            img = img.crop(bb)
-            (bb_l, bb_t, bb_r, bb_b) = bb
-            wd = bb_r - bb_l
-            ht = bb_b - bb_t
-
-            # offsets will be negative
-            nb_l = (wd - self.img_size) / 2
-            nb_t = (ht - self.img_size) / 2
-            nb_r = nb_l + self.img_size
-            nb_b = nb_t + self.img_size
-
-            img = img.crop((nb_l, nb_t, nb_r, nb_b))
-
-            return img
-
-        char_center(char_render()).save(filename)
-
-    # get the typeface name and family names from the file
-    def fontInfo(self, fontfile):
-        FAMILY_ID = 1
-        SUBFAMILY_ID = 2
-        NAME_ID = 4
-        PREFERRED_FAMILY_ID = 16
-
-        def decoded(val):
-            if '\000' in val:
-                return unicode(val, 'utf-16-be').encode('utf-8')
-            return unicode(val)
-
-        font = ttLib.TTFont(fontfile)
-        name = ""
-        family = ""
-        subfamily = ""
-        preferred_family = ""
-        for record in font['name'].names:
-            if record.langID not in [0, 1033]: continue
-
-            if record.nameID == NAME_ID and not name:
-                name = decoded(record.string)
-            elif record.nameID == FAMILY_ID and not family:
-                family = decoded(record.string)
-            elif record.nameID == SUBFAMILY_ID and not subfamily:
-                subfamily = decoded(record.string)
-            elif record.nameID == PREFERRED_FAMILY_ID and not preferred_family:
-                preferred_family = decoded(record.string)
-
-        # some fonts apparently have wrong names in field 1 and correct names in field 16
-        return name, (preferred_family if preferred_family else family), subfamily
+        if session is None:
+            session = RenderSession(font_file)
+
+        # extract features while the image is still in memory, so it never needs to be read back
+        img = session.render_centered(char, self.img_size)
+        self.atlas.put(font_name, char, img)
+        self.atlas.put_features(font_name, char, self.glyph_features(font_name, char, img))
 
+    # build filename for the glyph atlas of this size
+    def get_atlas_path(self):
+        return os.path.join(self.cache_dir, ATLAS_BASE_NAME + str(self.img_size))
 
     # build filename for specific font/char
     def get_cache_dirname(self, font_name):
@@ -256,11 +699,48 @@ class FontBank(object):
         thefile = str(self.img_size) + "_" + char + "." + CHAR_IMG_EXT
         return os.path.join(self.get_cache_dirname(font_name), thefile)
 
-    # get a CVFont object (cache-backed)
-    def get_font(self, font_name):
-        return CVFont(self.char_set, font_name, self.get_cache_filename)
-
-    # get a CVChar object (cache-backed)
-    def get_char(self, font_name, char):
-        filename = self.get_cache_filename(font_name, char)
-        return CVChar(font_name, char, filename)
+    # write per-character image files (e.g. for the HTML reports) for successfully cached fonts.
+    # overwrite: write images that are already there again (e.g. for fonts just re-rendered)
+    def export_char_images(self, font_names=None, overwrite=True):
+        if font_names is None:
+            font_names = self.successful_caches_names.keys()
+        for font_name in font_names:
+            mkdir(self.get_cache_dirname(font_name))
+            for char in self.char_set:
+                filename = self.get_cache_filename(font_name, char)
+                if self.atlas.has(font_name, char) and (overwrite or not os.path.exists(filename)):
+                    self.atlas.export(font_name, char, filename)
+
+    # get the contour features of a character, extracting (and storing) them if need be
+    def get_char_features(self, font_name, char):
+        if self.atlas.has_features(font_name, char):
+            return self.atlas.get_features(font_name, char)
+
+        features = self.glyph_features(font_name, char)
+        self.atlas.put_features(font_name, char, features)
+        return features
+
+    # the features of a cached glyph, from the feature cache if that glyph image was seen before.
+    # img: the glyph image, if it's at hand (otherwise it's read from the atlas)
+    def glyph_features(self, font_name, char, img=None):
+        key = self.feature_cache.key(self.atlas.glyph_bytes(font_name, char))
+        features = self.feature_cache.get(key)
+        if features is None:
+            cnt = image_char_contour(self.atlas.get(font_name, char) if img is None else img)
+            features = log_hu_moments(cnt)
+            self.feature_cache.put(key, features, cnt)
+        return features
+
+    # add features that were extracted elsewhere (e.g. by worker processes) to the feature cache,
+    # and save it.  if contours are being kept, those are extracted again from the atlas
+    def save_feature_cache(self, fonts):
+        keep = self.feature_cache.keep_contours
+        for font in fonts:
+            font_name = self.font_name[font]
+            for char in self.char_set:
+                if self.atlas.has_features(font_name, char):
+                    key = self.feature_cache.key(self.atlas.glyph_bytes(font_name, char))
+                    if self.feature_cache.get(key) is None or (keep and self.feature_cache.get_contour(key) is None):
+                        cnt = image_char_contour(self.atlas.get(font_name, char)) if keep else None
+                        self.feature_cache.put(key, self.atlas.get_features(font_name, char), cnt)
+        self.feature_cache.save()
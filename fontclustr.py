@@ -55,7 +55,7 @@ def showquit(img):
     sys.exit(1)
 
 
-fb = FontBank(FONT_CACHE_DIR, CHAR_IMG_SIZE, "AaBbCcGgHhKkOoPpTtXx", DiscreteProgress(0.1))
+fb = FontBank(FONT_CACHE_DIR, CHAR_IMG_SIZE, "AaBbCcGgHhKkOoPpTtXx", DiscreteProgress(0.1), export_images=True)
 
 
 
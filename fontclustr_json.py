@@ -1,12 +1,21 @@
-from progress import DiscreteProgress
-from fontbank import FontBank
-from distancebank import DistanceBank
+from distancebank import DistanceBank, JSON_OUTPUT_BASE_DIR
+from mclbank import MCLBank
+from cvfont import FEATURE_ENGINE_RASTER
 import string
-import itertools
-import json
+import multiprocessing
+import os
 
 FONT_CACHE_DIR = "cache"
 CHAR_IMG_SIZE = 200
+WORKERS = multiprocessing.cpu_count()
+FONT_DIRS = None  # None for the system font directories, or a list of directory trees
+FEATURE_ENGINE = FEATURE_ENGINE_RASTER  # or FEATURE_ENGINE_OUTLINE to skip rendering
+DISTANCE_TILE = None  # fonts per side of each tile of the distance matrix, or None to size by memory
+REFRESH_DISTANCES = False  # compare fonts installed since the distances were cached
+KNN = None  # for very large libraries: only find this many nearest neighbours of each font
+KEEP_CONTOURS = False  # also cache a simplified outline of every glyph alongside its features
+CLUSTER_FILE = os.path.join(JSON_OUTPUT_BASE_DIR, "allClusters.json")  # or None to leave it to index.js
+MCL_MAX_DEGREE = None  # approximate: join each font to at most this many fonts when clustering
 
 def mkCharSet():
     uc = string.uppercase
@@ -21,7 +30,10 @@ def mkCharSet():
 
 charset = mkCharSet()
 
-db = DistanceBank(FONT_CACHE_DIR, CHAR_IMG_SIZE)
-fonts, distances = db.get_distances(charset)
-print fonts
-print distances
+db = DistanceBank(FONT_CACHE_DIR, CHAR_IMG_SIZE, WORKERS, FONT_DIRS, engine=FEATURE_ENGINE, tile=DISTANCE_TILE, knn=KNN,
+                  keep_contours=KEEP_CONTOURS)
+fonts, distances = db.get_distances(charset, REFRESH_DISTANCES)
+print "Distances between %d fonts for %s" % (len(fonts), charset)
+
+if CLUSTER_FILE is not None:
+    MCLBank(fonts, distances, WORKERS, MCL_MAX_DEGREE).export_json(CLUSTER_FILE)
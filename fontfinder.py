@@ -0,0 +1,98 @@
+import os
+import sys
+import pickle
+
+# everything fontTools can read names from (collections are read as their first font)
+FONT_EXTENSIONS = ["ttf", "otf", "ttc", "otc"]
+
+
+# where fonts usually live on this platform
+def default_font_dirs():
+    home = os.path.expanduser("~")
+    if sys.platform.startswith("win"):
+        dirs = [os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts")]
+        if "LOCALAPPDATA" in os.environ:
+            dirs.append(os.path.join(os.environ["LOCALAPPDATA"], "Microsoft", "Windows", "Fonts"))
+        return dirs
+    if sys.platform == "darwin":
+        return ["/Library/Fonts",
+                "/System/Library/Fonts",
+                "/Network/Library/Fonts",
+                os.path.join(home, "Library", "Fonts")]
+    return ["/usr/share/fonts",
+            "/usr/local/share/fonts",
+            os.path.join(home, ".fonts"),
+            os.path.join(home, ".local", "share", "fonts")]
+
+
+# Finds font files under a set of directory trees.
+# A directory's listing only changes when its mtime does, so listings are cached by mtime
+# and unchanged directories are not re-read on the next run (only stat'ed).
+class FontFinder(object):
+
+    # font_dirs: directory trees to search (None for the platform defaults)
+    # cache_file: where to keep directory listings between runs (None to not keep them)
+    def __init__(self, font_dirs=None, cache_file=None, extensions=FONT_EXTENSIONS):
+        self.font_dirs = default_font_dirs() if font_dirs is None else font_dirs
+        self.cache_file = cache_file
+        self.extensions = set("." + e.lower() for e in extensions)
+        self.listings = None
+
+    def read_cache(self):
+        if self.cache_file is None:
+            return {}
+        try:
+            with open(self.cache_file, "rb") as f:
+                return pickle.load(f)
+        except:
+            return {}
+
+    def write_cache(self):
+        if self.cache_file is None:
+            return
+        with open(self.cache_file, "wb") as f:
+            pickle.dump(self.listings, f, -1)
+
+    # (font files, subdirectories) directly in a directory
+    def list_dir(self, path, old_listings):
+        mtime = os.stat(path).st_mtime
+        if path in old_listings and old_listings[path][0] == mtime:
+            listing = old_listings[path]
+        else:
+            files = []
+            subdirs = []
+            for entry in sorted(os.listdir(path)):
+                full = os.path.join(path, entry)
+                if os.path.isdir(full):
+                    subdirs.append(full)
+                elif os.path.splitext(entry)[1].lower() in self.extensions:
+                    files.append(full)
+            listing = (mtime, files, subdirs)
+
+        self.listings[path] = listing
+        return listing[1], listing[2]
+
+    # all font files in the font dirs, in a stable order
+    def find(self):
+        old_listings = self.read_cache()
+        self.listings = {}
+        visited = set()
+        ret = []
+
+        todo = [os.path.abspath(d) for d in reversed(self.font_dirs)]
+        while todo:
+            path = todo.pop()
+            real = os.path.realpath(path)
+            if real in visited or not os.path.isdir(path):
+                continue
+            visited.add(real)
+
+            try:
+                files, subdirs = self.list_dir(path, old_listings)
+            except OSError:
+                continue
+            ret.extend(files)
+            todo.extend(reversed(subdirs))
+
+        self.write_cache()
+        return ret
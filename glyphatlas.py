@@ -0,0 +1,217 @@
+import os
+import json
+import hashlib
+
+import numpy
+from numpy.lib import format as npformat
+from PIL import Image
+
+from cvfont import NUM_HU_MOMENTS
+
+ATLAS_INDEX_EXT = ".json"
+KEY_IMG_SIZE = "img_size"
+KEY_CHAR_SET = "char_set"
+KEY_FONTS = "fonts"
+
+# per-(font, char) arrays kept in the atlas: name -> (file extension, dtype, fill value)
+LAYER_GLYPHS = "glyphs"          # bit-packed glyph images
+LAYER_RENDERED = "rendered"      # whether the glyph image is there
+LAYER_FEATURES = "features"      # log Hu moments of the glyph's contour
+LAYER_FEATURED = "featured"      # whether the features are there
+LAYERS = {
+    LAYER_GLYPHS: (".npy", numpy.uint8, 0),
+    LAYER_RENDERED: ("_rendered.npy", numpy.bool_, False),
+    LAYER_FEATURES: ("_features.npy", numpy.float64, numpy.nan),
+    LAYER_FEATURED: ("_featured.npy", numpy.bool_, False),
+}
+
+
+# replace a file with a fully-written temporary one
+def _replace(tmp_filename, filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+
+# All cached glyph images for a set of fonts and characters, kept in memory-mapped files
+# instead of one PNG per glyph.  Glyphs are bit-packed: the array has shape
+# (n_fonts, n_chars, img_size, ceil(img_size / 8)), with a (n_fonts, n_chars) mask of which
+# glyphs have been rendered, and a small JSON index of the font names and charset.
+# The contour features of each glyph are kept alongside, so they never need re-extracting.
+#
+# If the atlas on disk was made for different fonts, or lacks some characters, it is
+# re-laid out and any glyphs that both layouts have in common are kept.  Characters are
+# never dropped, so that switching to a smaller charset and back costs nothing.
+class GlyphAtlas(object):
+
+    # base_path: filename of the atlas, without extension
+    # char_set: characters the atlas must be able to hold (it keeps any others it has)
+    # font_names: row order of the atlas
+    def __init__(self, base_path, img_size, char_set, font_names):
+        self.base_path = base_path
+        self.img_size = img_size
+        self.char_set = char_set
+        self.font_names = list(font_names)
+        self.font_index = dict((name, i) for i, name in enumerate(self.font_names))
+        self.char_index = None
+
+        self.layers = {}
+        self.open()
+
+    def filename(self, ext):
+        return self.base_path + ext
+
+    # shape of each glyph's entry in a layer
+    def cell_shape(self, layer):
+        if LAYER_GLYPHS == layer:
+            return (self.img_size, (self.img_size + 7) / 8)
+        if LAYER_FEATURES == layer:
+            return (NUM_HU_MOMENTS,)
+        return ()
+
+    def shape(self, layer):
+        return (len(self.font_names), len(self.char_set)) + self.cell_shape(layer)
+
+    # the index stored on disk, or None if there's no atlas there
+    def read_index(self):
+        try:
+            with open(self.filename(ATLAS_INDEX_EXT)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    # whether every layer is on disk (an older atlas may lack some)
+    def all_layers_exist(self):
+        return all(os.path.exists(self.filename(ext)) for ext, _, _ in LAYERS.values())
+
+    # map every layer's file, writable
+    def load_layers(self):
+        for layer, (ext, _, _) in LAYERS.items():
+            self.layers[layer] = numpy.load(self.filename(ext), mmap_mode="r+")
+
+    # an atlas is pickled (e.g. to hand it to a worker process) without its arrays, which would
+    # otherwise arrive as in-memory copies that writes never leave.  the other side maps the
+    # files again, so what it stores goes to the atlas on disk
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["layers"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load_layers()
+
+    def open(self):
+        index = self.read_index()
+        if index is not None and index[KEY_IMG_SIZE] == self.img_size:
+            old_chars = index[KEY_CHAR_SET]
+            self.char_set = old_chars + "".join(c for c in self.char_set if c not in old_chars)
+        self.char_index = dict((c, i) for i, c in enumerate(self.char_set))
+
+        if (index is not None
+            and index[KEY_IMG_SIZE] == self.img_size
+            and index[KEY_CHAR_SET] == self.char_set
+            and index[KEY_FONTS] == self.font_names
+            and self.all_layers_exist()):
+            self.load_layers()
+            return
+
+        self.create(index)
+
+    # lay out a new atlas, carrying over whatever the old one (if any) has in common with it
+    def create(self, old_index):
+        tmp = ".tmp"
+        carry = old_index is not None and old_index[KEY_IMG_SIZE] == self.img_size
+        if carry:
+            old_fonts = dict((name, i) for i, name in enumerate(old_index[KEY_FONTS]))
+            old_chars = dict((c, i) for i, c in enumerate(old_index[KEY_CHAR_SET]))
+            char_pairs = [(j, old_chars[c]) for c, j in self.char_index.items() if c in old_chars]
+            new_cols = [j for j, _ in char_pairs]
+            old_cols = [k for _, k in char_pairs]
+
+        for layer, (ext, dtype, fill) in LAYERS.items():
+            new = npformat.open_memmap(self.filename(ext + tmp), mode="w+", dtype=dtype, shape=self.shape(layer))
+            new[:] = fill
+
+            if carry and os.path.exists(self.filename(ext)):
+                old = numpy.load(self.filename(ext), mmap_mode="r")
+                for name, i in self.font_index.items():
+                    if name not in old_fonts: continue
+                    new[i, new_cols] = old[old_fonts[name], old_cols]
+                del old
+
+            new.flush()
+            del new
+
+        for ext, _, _ in LAYERS.values():
+            _replace(self.filename(ext + tmp), self.filename(ext))
+        with open(self.filename(ATLAS_INDEX_EXT), "w") as f:
+            json.dump({
+                KEY_IMG_SIZE: self.img_size,
+                KEY_CHAR_SET: self.char_set,
+                KEY_FONTS: self.font_names
+            }, f)
+
+        self.load_layers()
+
+    def flush(self):
+        for layer in self.layers.values():
+            layer.flush()
+
+    # whether a glyph has been stored
+    def has(self, font_name, char):
+        return bool(self.layers[LAYER_RENDERED][self.font_index[font_name], self.char_index[char]])
+
+    # whether a glyph's features have been stored
+    def has_features(self, font_name, char):
+        return bool(self.layers[LAYER_FEATURED][self.font_index[font_name], self.char_index[char]])
+
+    # store a glyph from a PIL image (or anything numpy can make a 2d array from),
+    # and optionally its features
+    def put(self, font_name, char, img, features=None):
+        i = self.font_index[font_name]
+        j = self.char_index[char]
+        bits = numpy.asarray(img) != 0
+        self.layers[LAYER_GLYPHS][i, j] = numpy.packbits(bits, axis=-1)
+        self.layers[LAYER_RENDERED][i, j] = True
+        self.layers[LAYER_FEATURED][i, j] = False
+        if features is not None:
+            self.put_features(font_name, char, features)
+
+    def put_features(self, font_name, char, features):
+        i = self.font_index[font_name]
+        j = self.char_index[char]
+        self.layers[LAYER_FEATURES][i, j] = features
+        self.layers[LAYER_FEATURED][i, j] = True
+
+    # forget all glyphs of a font
+    def clear(self, font_name):
+        i = self.font_index[font_name]
+        self.layers[LAYER_RENDERED][i] = False
+        self.layers[LAYER_FEATURED][i] = False
+
+    # the stored (packed) bytes of a glyph
+    def glyph_bytes(self, font_name, char):
+        return self.layers[LAYER_GLYPHS][self.font_index[font_name], self.char_index[char]].tobytes()
+
+    # a digest of all of a font's glyphs for some characters
+    def glyph_digest(self, font_name, chars):
+        h = hashlib.sha1()
+        for c in chars:
+            h.update(self.glyph_bytes(font_name, c))
+        return h.hexdigest()
+
+    # a glyph as a white-on-black uint8 image, suitable for opencv
+    def get(self, font_name, char):
+        i = self.font_index[font_name]
+        j = self.char_index[char]
+        bits = numpy.unpackbits(self.layers[LAYER_GLYPHS][i, j], axis=-1)[:, :self.img_size]
+        return bits * numpy.uint8(255)
+
+    # a glyph's stored features
+    def get_features(self, font_name, char):
+        return numpy.array(self.layers[LAYER_FEATURES][self.font_index[font_name], self.char_index[char]])
+
+    # write a glyph out as an image file (e.g. for the HTML reports)
+    def export(self, font_name, char, filename):
+        Image.fromarray(self.get(font_name, char)).save(filename)
@@ -0,0 +1,99 @@
+import numpy
+import scipy.sparse
+
+# dtype of one neighbour in a saved graph
+KNN_DTYPE = [("index", "<i4"), ("distance", "<f8")]
+
+
+# leaves of a random projection tree: each node splits its points in half along a random
+# direction, until no more than leaf_size are left.  points that end up in the same leaf are
+# likely to be near each other
+def rp_tree_leaves(points, leaf_size, rng):
+    leaves = []
+    todo = [numpy.arange(len(points))]
+    while todo:
+        idx = todo.pop()
+        if len(idx) <= leaf_size:
+            leaves.append(idx)
+            continue
+        proj = numpy.dot(points[idx], rng.randn(points.shape[1]))
+        order = numpy.argsort(proj)
+        half = len(idx) / 2
+        todo.append(idx[order[:half]])
+        todo.append(idx[order[half:]])
+    return leaves
+
+
+# The k nearest neighbours of every font, as (n, k) arrays of indices and distances, sorted
+# nearest first.  Rows with fewer than k neighbours found are padded with index -1 and an
+# infinite distance.  Pairs that aren't neighbours (in either direction) are treated as
+# infinitely far apart
+class KNNGraph(object):
+
+    def __init__(self, indices, distances):
+        self.indices = indices
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.indices)
+
+    @classmethod
+    def empty(cls, n, k):
+        indices = numpy.empty((n, k), dtype=numpy.intp)
+        indices.fill(-1)
+        distances = numpy.empty((n, k))
+        distances.fill(numpy.inf)
+        return cls(indices, distances)
+
+    # merge candidate neighbours into the graph.
+    # rows: fonts the candidates are for; cand_indices, cand_distances: (len(rows), m) arrays
+    def merge(self, rows, cand_indices, cand_distances):
+        k = self.indices.shape[1]
+        idx = numpy.concatenate([self.indices[rows], cand_indices], axis=1)
+        dist = numpy.concatenate([self.distances[rows], cand_distances], axis=1)
+        dist = numpy.where(numpy.isnan(dist) | (idx < 0) | (idx == numpy.asarray(rows)[:, None]), numpy.inf, dist)
+
+        # a neighbour can come up more than once; keep only one of it
+        r = numpy.arange(len(idx))[:, None]
+        order = numpy.argsort(idx, axis=1, kind="mergesort")
+        idx = idx[r, order]
+        dist = dist[r, order]
+        dupe = numpy.zeros(idx.shape, dtype=numpy.bool_)
+        dupe[:, 1:] = idx[:, 1:] == idx[:, :-1]
+        dist[dupe] = numpy.inf
+
+        nearest = numpy.argsort(dist, axis=1, kind="mergesort")[:, :k]
+        self.distances[rows] = dist[r, nearest]
+        self.indices[rows] = numpy.where(numpy.isinf(dist[r, nearest]), -1, idx[r, nearest])
+
+    # the graph as a symmetric sparse matrix of distances (a pair is an edge if either font
+    # is a neighbour of the other).  zero distances are kept as explicit entries
+    def to_sparse(self):
+        n, k = self.indices.shape
+        found = 0 <= self.indices
+        rows = numpy.repeat(numpy.arange(n), k)[found.ravel()]
+        cols = self.indices[found]
+        dist = self.distances[found]
+
+        # an edge found from both ends is only kept once
+        a = numpy.minimum(rows, cols)
+        b = numpy.maximum(rows, cols)
+        _, first = numpy.unique(a.astype(numpy.int64) * n + b, return_index=True)
+        a, b, dist = a[first], b[first], dist[first]
+        return scipy.sparse.csr_matrix((numpy.concatenate([dist, dist]),
+                                        (numpy.concatenate([a, b]), numpy.concatenate([b, a]))), shape=(n, n))
+
+    # the neighbours of font i, as a list of (index, distance), nearest first
+    def neighbours(self, i):
+        return [(int(j), float(d)) for j, d in zip(self.indices[i], self.distances[i]) if 0 <= j]
+
+    # one array of (index, distance) records, for saving
+    def to_records(self):
+        ret = numpy.empty(self.indices.shape, dtype=KNN_DTYPE)
+        ret["index"] = self.indices
+        ret["distance"] = self.distances
+        return ret
+
+    @classmethod
+    def from_records(cls, records):
+        return cls(numpy.array(records["index"], dtype=numpy.intp), numpy.array(records["distance"]))
@@ -1,55 +1,196 @@
 import json
-import networkx
+import multiprocessing
 import numpy
-from mcl.mcl_clustering import networkx_mcl
+import scipy.sparse
 import pprint
 
+from knngraph import KNNGraph
+from sparsemcl import mcl, threshold_graph
+
+# the quantiles of a subset's distances to try as thresholds, in order, until one splits it
+MCL_QUANTILES = [40.0, 20.0, 10.0, 5.0, 2.5]
+# most rounds of inflation and expansion per MCL run
+MCL_MAX_LOOP = 100
+# clusters with more members than this are split into sub-clusters
+MCL_LEAF_SIZE = 5
+# with workers, clusters of up to this many fonts are refined all the way down in one task;
+# bigger ones are split one level at a time, so the pool can share out their sub-clusters
+MCL_SUBTREE_FONTS = 200
+# how long to wait on the oldest outstanding task before checking the others
+MCL_POLL_SECONDS = 0.05
+
+
+# when clusters have overlap, keep each member only in the smallest cluster it's in
+# (the first of those, on a tie).  clusters left empty are dropped
+def de_duplicate(clusters):
+    home = {}
+    for i, cluster in enumerate(clusters):
+        for member in cluster:
+            if member not in home or len(cluster) < len(clusters[home[member]]):
+                home[member] = i
+
+    ret = [[] for _ in clusters]
+    for member in sorted(home):
+        ret[home[member]].append(member)
+    return [c for c in ret if c]
+
+
+# worker processes get their own copy of the MCL bank, set once by the pool initializer
+_worker_mcl_bank = None
+
+def _init_cluster_worker(mcl_bank):
+    global _worker_mcl_bank
+    _worker_mcl_bank = mcl_bank
+
+# refine one cluster: its whole hierarchy, or only its next level of clusters
+def _refine_cluster(task):
+    ids, whole = task
+    if whole:
+        return _worker_mcl_bank.mch(ids)
+    return _worker_mcl_bank.level(ids)
+
+
 # An MCL solver object.
 # https://www.cs.ucsb.edu/~xyan/classes/CS595D-2009winter/MCL_Presentation2.pdf
 # https://www.cs.umd.edu/class/fall2009/cmsc858l/lecs/Lec12-mcl.pdf
 class MCLBank(object):
 
     # font_info: array of font information dicts
-    # distances: 2d array of font distances, indexes align with font_info
-    def __init__(self, font_info, distances):
+    # distances: 2d array of font distances, indexes align with font_info.
+    #   or a KNNGraph, in which case fonts that aren't neighbours are never joined
+    # workers: number of processes to refine sub-clusters in
+    # max_degree: join each font to at most this many of its nearest fonts under a threshold.
+    #   an approximation that keeps big graphs sparse; None to join every pair under it
+    # fonts are referred to by their index in font_info throughout
+    def __init__(self, font_info, distances, workers=1, max_degree=None):
+        self.font_info = font_info
+        self.workers = workers
+        self.max_degree = max_degree
         self.font_names = [f["name"] for f in font_info]
-        self.data = dict([(f["name"], {
-            "font": f,
-            "distance_to": dict([(f2["name"], distances[i][j]) for j, f2 in enumerate(font_info)])
-        }) for i, f in enumerate(font_info)])
+        if isinstance(distances, KNNGraph):
+            self.distances = distances.to_sparse()
+        else:
+            self.distances = numpy.asarray(distances, dtype=numpy.float64)
 
+    # distances among some fonts, as a submatrix (sparse if the distances are)
+    def submatrix(self, ids):
+        if scipy.sparse.issparse(self.distances):
+            return self.distances[ids][:, ids]
+        return self.distances[numpy.ix_(ids, ids)]
 
-    def multilevel_cluster(self):
-        print "multilevel_cluster"
+    # the distances between each pair of fonts in a submatrix (that were compared)
+    def pair_distances(self, sub):
+        if scipy.sparse.issparse(sub):
+            near = sub.tocoo()
+            return near.data[near.row < near.col]
+        if len(sub) < 2:
+            return numpy.zeros(0)
+        return numpy.concatenate([sub[i, i + 1:] for i in range(len(sub) - 1)])
 
-        # multicluster helper
-        def mch(font_names):
-            print "mch of", len(font_names), font_names
-            distances = numpy.array([self.data[i]["distance_to"][j] for i in font_names for j in font_names if i != j])
+    # the quantile q (a percentage) of some distances, already sorted.  same as the stats.js
+    # quantile index.js uses: the value at the quantile's rank, or the average of the two values
+    # either side of it if it falls on a boundary
+    def quantile(self, sorted_distances, q):
+        n = len(sorted_distances)
+        idx = q / 100.0 * n - 1
+        if idx < 0: return sorted_distances[0]
+        if n - 1 <= idx: return sorted_distances[n - 1]
+        if idx == int(idx):
+            return 0.5 * (sorted_distances[int(idx)] + sorted_distances[int(idx) + 1])
+        return sorted_distances[int(numpy.ceil(idx))]
 
+    # split some fonts at the first of MCL_QUANTILES of their distances that splits them at all,
+    # or return them as one cluster if none does.  clusters are arrays of font indexes.
+    # the graphs of lower thresholds only lose edges, so a graph with as many edges as the last
+    # one is the same graph, and isn't clustered again
+    def split(self, ids, matrix, sorted_distances):
+        last_edges = None
+        solution = [ids]
+        for q in MCL_QUANTILES:
             # et for Edge Threshold
-            def get_graph(et):
-                g = networkx.Graph()
-                g.add_nodes_from(font_names)
-                edges = [(i, j) for i in font_names for j in font_names if i < j and self.data[i]["distance_to"][j] < et]
-                g.add_edges_from(edges)
-                return g
-
-            solution = [font_names]  # start with one cluster and try to break it apart
-            quantile = 80.0          # we want to start at 40, so double it to start
-            while 2.5 < quantile and 1 == len(solution):
-                quantile = quantile * 0.5
-                threshold = numpy.percentile(distances, quantile)
-                g = get_graph(threshold)
-                _, solution = networkx_mcl(g) #expand_factor = <expand_factor>,
-                                              #inflate_factor = <inflate_factor>,
-                                              #max_loop = <max_loop>,
-                                              #mult_factor = <mult_factor>)
-
-            if 1 == len(solution.keys()): return solution  # nothing more we can do
-
-            # if a cluster has more than 5 members, recurse down
-            return [c if 5 >= len(c) else mch(c) for c in solution]
+            graph = threshold_graph(matrix, self.quantile(sorted_distances, q), self.max_degree)
+            if graph.nnz != last_edges:
+                clusters = mcl(graph, max_loop=MCL_MAX_LOOP, overlap=True) #expand_factor = <expand_factor>,
+                                                                           #inflate_factor = <inflate_factor>,
+                                                                           #mult_factor = <mult_factor>)
+                solution = [ids[c] for c in de_duplicate(clusters)]
+                last_edges = graph.nnz
+            if 1 < len(solution): break
+        return solution
+
+    def names(self, ids):
+        return [self.font_names[i] for i in ids]
+
+    # one level of the hierarchy: the clusters (arrays of font indexes) some fonts split into,
+    # or None if they can't be split
+    def level(self, ids):
+        print "mch of", len(ids), self.names(ids)
+        matrix = self.submatrix(ids)
+        distances = self.pair_distances(matrix)
+        distances = numpy.sort(distances[numpy.isfinite(distances)])
+        if not len(distances): return None
+
+        solution = self.split(ids, matrix, distances)
+        if 1 == len(solution): return None  # nothing more we can do
+        return solution
+
+    # multicluster helper.  ids: array of font indexes
+    def mch(self, ids):
+        solution = self.level(ids)
+        if solution is None: return [self.names(ids)]
+
+        # if a cluster has more than 5 members, recurse down
+        return [self.names(c) if MCL_LEAF_SIZE >= len(c) else self.mch(c) for c in solution]
+
+    # the same hierarchy as mch, with the sub-clusters refined across a pool of processes.
+    # every task's result goes into the slot its cluster was given in its parent's list, so
+    # the hierarchy comes out in the same order whichever tasks finish first
+    def mch_parallel(self, ids):
+        pool = multiprocessing.Pool(self.workers, _init_cluster_worker, (self,))
+        try:
+            top = [None]
+            pending = []
+
+            def refine(ids, parent, slot):
+                whole = len(ids) <= MCL_SUBTREE_FONTS
+                pending.append((pool.apply_async(_refine_cluster, [(ids, whole)]), ids, whole, parent, slot))
+
+            refine(ids, top, 0)
+            while pending:
+                pending[0][0].wait(MCL_POLL_SECONDS)
+                ready = [task[0].ready() for task in pending]
+                finished = [task for task, r in zip(pending, ready) if r]
+                pending[:] = [task for task, r in zip(pending, ready) if not r]
+                for result, cluster, whole, parent, slot in finished:
+                    solution = result.get()
+                    if whole:
+                        parent[slot] = solution
+                    elif solution is None:
+                        parent[slot] = [self.names(cluster)]
+                    else:
+                        parent[slot] = [self.names(c) if MCL_LEAF_SIZE >= len(c) else None for c in solution]
+                        for i, c in enumerate(solution):
+                            if MCL_LEAF_SIZE < len(c):
+                                refine(c, parent[slot], i)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return top[0]
+
+    def multilevel_cluster(self):
+        print "multilevel_cluster"
 
         # start from the top
-        return mch(self.font_names)
+        ids = numpy.arange(len(self.font_names))
+        if 1 < self.workers:
+            return self.mch_parallel(ids)
+        return self.mch(ids)
+
+    # cluster the fonts and write the hierarchy out as JSON, for the report (in place of
+    # running index.js on the exported distances)
+    def export_json(self, filename):
+        hierarchy = self.multilevel_cluster()
+        with open(filename, "w") as outfile:
+            json.dump(hierarchy, outfile, indent=2)
+        return hierarchy
@@ -0,0 +1,119 @@
+import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
+
+# entries of the flow matrix smaller than this are dropped after each expansion
+MCL_PRUNE_THRESHOLD = 1e-4
+# at most this many entries are kept in each column of the flow matrix after each expansion
+MCL_SELECT = 100
+# the flow matrix has converged once an iteration changes no entry by more than this
+MCL_TOLERANCE = 1e-9
+# rows of the distance matrix to threshold at once
+THRESHOLD_BLOCK_ROWS = 1024
+
+
+# an unweighted graph joining pairs of fonts closer than a threshold, as a sparse adjacency
+# matrix.  distances: (n, n) array (infinite for pairs that aren't to be joined), or a sparse
+# matrix (in which case pairs without an entry are never joined).
+# max_degree: how many of its nearest fonts each font may pick (plus any that picked it), so a
+# high threshold over many fonts doesn't make a dense graph.  this changes the graph, and so the
+# clusters, for more than max_degree + 1 fonts.  None (the default) joins every pair under the threshold
+def threshold_graph(distances, threshold, max_degree=None):
+    n = distances.shape[0]
+    if scipy.sparse.issparse(distances):
+        near = distances.tocoo()
+        keep = (near.row != near.col) & (near.data < threshold)
+        picked = scipy.sparse.csr_matrix((numpy.ones(keep.sum()), (near.row[keep], near.col[keep])), shape=(n, n))
+        return (picked + picked.T).sign()
+
+    rows = []
+    cols = []
+    for start in range(0, n, THRESHOLD_BLOCK_ROWS):
+        block = numpy.array(distances[start:start + THRESHOLD_BLOCK_ROWS], dtype=numpy.float64)
+        r = numpy.arange(len(block))
+        block[r, start + r] = numpy.inf
+        if max_degree is not None and max_degree < n - 1:
+            nearest = numpy.argpartition(block, max_degree, axis=1)[:, :max_degree]
+            keep = block[r[:, None], nearest] < threshold
+            rows.append(start + numpy.nonzero(keep)[0])
+            cols.append(nearest[keep])
+        else:
+            i, j = numpy.nonzero(block < threshold)
+            rows.append(start + i)
+            cols.append(j)
+
+    rows = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=numpy.intp)
+    cols = numpy.concatenate(cols) if cols else numpy.zeros(0, dtype=numpy.intp)
+    picked = scipy.sparse.csr_matrix((numpy.ones(len(rows)), (rows, cols)), shape=(n, n))
+    return (picked + picked.T).sign()
+
+
+# scale each column of a sparse matrix to sum to 1
+def normalize(m):
+    sums = numpy.asarray(m.sum(axis=0)).ravel()
+    sums[0 == sums] = 1.0
+    return scipy.sparse.csr_matrix(m.multiply(1.0 / sums[None, :]))
+
+
+# drop the tiny entries that expansion leaves everywhere, and all but the largest few of
+# each column, so the matrix stays sparse
+def prune(m, threshold, select=MCL_SELECT):
+    m = scipy.sparse.csc_matrix(m)
+    m.data[m.data < threshold] = 0
+    m.eliminate_zeros()
+    if select is not None and 0 < m.nnz and select < numpy.diff(m.indptr).max():
+        cols = numpy.repeat(numpy.arange(m.shape[1]), numpy.diff(m.indptr))
+        order = numpy.lexsort((-m.data, cols))
+        rank = numpy.empty(m.nnz, dtype=numpy.intp)
+        rank[order] = numpy.arange(m.nnz) - m.indptr[cols[order]]
+        m.data[select <= rank] = 0
+        m.eliminate_zeros()
+    return m.tocsr()
+
+
+# Markov clustering of a graph given as a sparse adjacency matrix, done on sparse matrices
+# throughout.  Same steps and defaults as networkx_mcl (self loops, then inflation and expansion
+# until the flow matrix stops changing), with pruning after each expansion.
+# returns the clusters as lists of node indices.  every node is in exactly one cluster, unless
+# overlap is set: then a node is in every cluster any of its flow ends up at
+def mcl(adjacency, expand_factor=2, inflate_factor=2, max_loop=10, mult_factor=1,
+        prune_threshold=MCL_PRUNE_THRESHOLD, select=MCL_SELECT, overlap=False):
+    n = adjacency.shape[0]
+    m = normalize(scipy.sparse.csr_matrix(adjacency) + mult_factor * scipy.sparse.identity(n, format="csr"))
+    for _ in range(max_loop):
+        last = m
+        m = normalize(m.power(inflate_factor))
+        expanded = m
+        for _ in range(expand_factor - 1):
+            expanded = expanded * m
+        m = normalize(prune(expanded, prune_threshold, select))
+        change = abs(m - last)
+        if 0 == change.nnz or change.max() <= MCL_TOLERANCE:
+            break
+
+    # attractors (nodes that keep some of their own flow) that share flow make up one cluster,
+    # and each node joins the cluster of the attractor most of its flow ends up at
+    m = m.tocsr()
+    attractors = numpy.flatnonzero(0 < m.diagonal())
+    if not len(attractors):
+        return [range(n)]
+    flow = m[attractors]
+    _, group = scipy.sparse.csgraph.connected_components(flow[:, attractors], directed=True, connection="weak")
+    # a node with no flow to any attractor is a cluster of its own
+    lost = numpy.flatnonzero(0 == numpy.asarray(flow.max(axis=0).todense()).ravel())
+
+    if overlap:
+        groups = scipy.sparse.csr_matrix((numpy.ones(len(attractors)), (group, numpy.arange(len(attractors)))))
+        reached = (groups * flow).tocsr()
+        reached.eliminate_zeros()
+        reached.sort_indices()
+        return ([list(reached.indices[reached.indptr[g]:reached.indptr[g + 1]]) for g in range(reached.shape[0])]
+                + [[j] for j in lost])
+
+    best = numpy.asarray(flow.argmax(axis=0)).ravel()
+    home = group[best]
+    home[lost] = group.max() + 1 + numpy.arange(len(lost))
+
+    order = numpy.argsort(home, kind="mergesort")
+    bounds = numpy.flatnonzero(numpy.diff(home[order])) + 1
+    return [list(c) for c in numpy.split(order, bounds)]